@@ -0,0 +1,227 @@
+# =============================================================================
+# Benchmarks of the scoring and networking stages on synthetic spectra
+#
+# python -m molnet.benchmark --n_spectra 2000 --save baseline.json
+# python -m molnet.benchmark --n_spectra 2000 --baseline baseline.json
+#
+# Each stage reports its throughput (pairs/s or spectra/s) and the peak
+# memory allocated while it runs (tracemalloc, measured in a separate run so
+# that tracing doesn't slow the timed runs). With --baseline the results are
+# compared to an earlier --save and the exit status is 1 if any stage got
+# slower by more than --tolerance.
+# =============================================================================
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from molnet.mnet import Spectrum,Cluster,Graph,make_initial_network,mol_network,score_pairs
+from molnet.scoring_functions import fast_cosine,fast_cosine_shift,find_pairs
+from molnet.spec_lib import SpecLib
+
+
+def synthetic_spectra(n_spectra,n_peaks = 30,mz_range = (100.0,1000.0),family_size = 5,family_fraction = 0.5,noise_peaks = 5,seed = 0):
+    # Seeded random MS2 spectra with a family structure: a family_fraction of
+    # the spectra come in families of up to family_size analogues of a
+    # common parent, which differ from it by a mass shift (all fragments
+    # containing the modification move with the precursor), lose some of
+    # its fragments and gain noise_peaks random ones. The others are
+    # unrelated singletons. Returns the spectra and the family number of
+    # each (None for singletons).
+    rng = random.Random(seed)
+    low,high = mz_range
+    spectra = []
+    families = []
+    family = 0
+    while len(spectra) < n_spectra:
+        parent_mz = rng.uniform(low,high)
+        fragments = [(rng.uniform(low/2.0,parent_mz),rng.uniform(1.0,100.0)) for p in range(n_peaks)]
+        if rng.random() < family_fraction:
+            size = min(rng.randint(2,max(2,family_size)),n_spectra - len(spectra))
+            label = family
+            family += 1
+        else:
+            size = 1
+            label = None
+        modified = [rng.random() < 0.5 for p in fragments]
+        for member in range(size):
+            shift = 0.0 if member == 0 else rng.choice([14.016,15.995,2.016,-14.016,rng.uniform(-50.0,50.0)])
+            peaks = []
+            for (mz,intensity),moves in zip(fragments,modified):
+                if member > 0 and rng.random() < 0.2:
+                    continue
+                mz = mz + shift if moves else mz
+                if mz > 0:
+                    peaks.append((mz + rng.gauss(0,0.002),intensity*rng.uniform(0.7,1.3)))
+            for p in range(noise_peaks):
+                peaks.append((rng.uniform(low/2.0,parent_mz + shift),rng.uniform(1.0,20.0)))
+            rt = rng.uniform(60.0,1200.0)
+            spectra.append(Spectrum(peaks,'synthetic',len(spectra),None,parent_mz + shift,parent_mz + shift,rt = rt,metadata = {}))
+            families.append(label)
+    return spectra,families
+
+
+def time_stage(function,repeats = 3):
+    # best wall time of repeats runs of function() and its peak memory
+    # allocation (bytes) over one more, traced, run
+    times = []
+    for r in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times),peak
+
+
+def run_benchmarks(n_spectra = 1000,n_pairs = 2000,n_queries = 50,n_peaks = 30,mz_range = (100.0,1000.0),family_size = 5,
+        tolerance = 0.2,min_match = 3,score_threshold = 0.7,k = 10,beta = 100,n_jobs = 1,repeats = 3,seed = 0,stages = None):
+    # Run the benchmark stages (all, or those named in stages) and return a
+    # dict of stage name -> {'seconds','peak_bytes','items','unit','rate'}
+    spectra,families = synthetic_spectra(n_spectra,n_peaks = n_peaks,mz_range = mz_range,family_size = family_size,seed = seed)
+    clusters = [Cluster(s,i) for i,s in enumerate(spectra)]
+    rng = random.Random(seed)
+    pairs = [(rng.choice(spectra),rng.choice(spectra)) for p in range(n_pairs)]
+
+    def score_all(function):
+        for s1,s2 in pairs:
+            function(s1,s2,tolerance,min_match)
+
+    def find_all():
+        for s1,s2 in pairs:
+            find_pairs(s1.normalised_peaks,s2.normalised_peaks,tolerance,shift = s1.precursor_mz - s2.precursor_mz)
+
+    stats = {}
+    def network():
+        make_initial_network(clusters,fast_cosine_shift,tolerance,min_match,score_threshold,k = k,n_jobs = n_jobs,stats = stats)
+
+    # the unfiltered network for the top-k stage
+    network_graph = []
+    def build_unfiltered():
+        filtered_cluster_list,edges = score_pairs(clusters,fast_cosine_shift,tolerance,min_match,score_threshold,n_jobs = n_jobs)
+        G = Graph()
+        for cluster in filtered_cluster_list:
+            G.add_node(cluster)
+        for i,j,score in edges:
+            G.add_edge(filtered_cluster_list[i],filtered_cluster_list[j],score)
+        network_graph.append(G)
+
+    def topk():
+        network_graph[0].topk_filter(k = k)
+
+    def families_stage():
+        mol_network(clusters,fast_cosine_shift,tolerance,min_match,score_threshold,k = k,beta = beta,n_jobs = n_jobs)
+
+    library = SpecLib(None)
+    library.spectra = {}
+    for i,s in enumerate(spectra):
+        s.spectrum_id = 'SYN{}'.format(i)
+        library.spectra[s.spectrum_id] = s
+    queries = spectra[:n_queries]
+    def match():
+        for query in queries:
+            library.spectral_match(query,ms2_tol = tolerance,min_match_peaks = min_match,ms1_tol = 1.0,score_thresh = score_threshold)
+
+    all_stages = [
+        ('fast_cosine',lambda: score_all(fast_cosine),n_pairs,'pairs'),
+        ('fast_cosine_shift',lambda: score_all(fast_cosine_shift),n_pairs,'pairs'),
+        ('find_pairs',find_all,n_pairs,'pairs'),
+        ('make_initial_network',network,None,'pairs'),
+        ('topk_filter',topk,n_spectra,'spectra'),
+        ('mol_network',families_stage,n_spectra,'spectra'),
+        ('spectral_match',match,n_queries,'spectra'),
+    ]
+    results = {}
+    for name,function,items,unit in all_stages:
+        if stages and not name in stages:
+            continue
+        print("Running {}".format(name),file = sys.stderr)
+        # the stages print their progress, which would swamp the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            if name == 'topk_filter' and not network_graph:
+                build_unfiltered()
+            seconds,peak = time_stage(function,repeats = repeats)
+        if items is None:
+            items = stats.get('n_pairs_scored',0)
+        results[name] = {'seconds': seconds,'peak_bytes': peak,'items': items,'unit': unit,
+            'rate': items/seconds if seconds > 0 else float('inf')}
+    return results
+
+
+def compare(results,baseline,tolerance = 0.2):
+    # stages whose rate dropped by more than tolerance (a fraction) from the
+    # baseline, as a list of (stage,baseline rate,rate)
+    regressions = []
+    for name,result in results.items():
+        if name in baseline and result['rate'] < baseline[name]['rate']*(1.0 - tolerance):
+            regressions.append((name,baseline[name]['rate'],result['rate']))
+    return regressions
+
+
+def print_results(results,baseline = None):
+    print("{:<22}{:>12}{:>24}{:>12}{:>10}".format('stage','seconds','rate','peak MB','vs base'))
+    for name,result in results.items():
+        change = ''
+        if baseline and name in baseline and baseline[name]['rate'] > 0:
+            change = "{:+.0%}".format(result['rate']/baseline[name]['rate'] - 1.0)
+        print("{:<22}{:>12.4f}{:>24}{:>12.1f}{:>10}".format(name,result['seconds'],
+            "{:.1f} {}/s".format(result['rate'],result['unit']),result['peak_bytes']/1e6,change))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark molnet scoring and networking on synthetic spectra')
+    parser.add_argument('--n_spectra',type = int,default = 1000)
+    parser.add_argument('--n_pairs',type = int,default = 2000,help = 'random pairs for the single pair scoring stages')
+    parser.add_argument('--n_queries',type = int,default = 50,help = 'library queries for spectral_match')
+    parser.add_argument('--n_peaks',type = int,default = 30)
+    parser.add_argument('--mz_min',type = float,default = 100.0)
+    parser.add_argument('--mz_max',type = float,default = 1000.0)
+    parser.add_argument('--family_size',type = int,default = 5)
+    parser.add_argument('--n_jobs',type = int,default = 1)
+    parser.add_argument('--repeats',type = int,default = 3)
+    parser.add_argument('--seed',type = int,default = 0)
+    parser.add_argument('--stages',nargs = '*',help = 'only run these stages')
+    parser.add_argument('--save',help = 'write the results to this json file')
+    parser.add_argument('--baseline',help = 'compare to the results in this json file')
+    parser.add_argument('--tolerance',type = float,default = 0.2,help = 'allowed fractional slowdown vs the baseline')
+    args = parser.parse_args(argv)
+
+    settings = dict([(key,getattr(args,key)) for key in ('n_spectra','n_pairs','n_queries','n_peaks','family_size','n_jobs','seed')])
+    results = run_benchmarks(mz_range = (args.mz_min,args.mz_max),repeats = args.repeats,stages = args.stages,**settings)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline,'r') as f:
+            saved = json.load(f)
+        if saved['settings'] != settings:
+            print("Warning: baseline was run with different settings {}".format(saved['settings']),file = sys.stderr)
+        baseline = saved['results']
+    print_results(results,baseline = baseline)
+
+    if args.save:
+        with open(args.save,'w') as f:
+            json.dump({'settings': settings,'python': platform.python_version(),'results': results},f,indent = 2)
+
+    if baseline:
+        regressions = compare(results,baseline,tolerance = args.tolerance)
+        for name,before,after in regressions:
+            print("REGRESSION {}: {:.1f} -> {:.1f} per second".format(name,before,after))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,7 @@ import json
 import jsonpickle
 import pandas as pd
 import sys
+import os
 import math
 import numpy as np
 
@@ -10,6 +11,8 @@ from molnet.mnet import Spectrum, Cluster, mol_network
 from molnet.scoring_functions import  fast_cosine_shift
 from molnet.bokeh_nx import mn_display
 from molnet.spec_lib import SpecLib
+from molnet.library_store import open_library_store
+from molnet.score_cache import ScoreCache
 
 # =============================================================================
 #  api to extract data from FrAnK (created by Dr Joe Wandy)
@@ -48,6 +51,12 @@ token = 'e77570ee7f5665c604449ffb4ceba52b06c8603a'
 
 #analysis_id = 1321 # example beer analysis
 
+# pairwise scores are kept between requests, so rerunning an analysis with
+# a different threshold or k doesn't rescore every pair
+score_cache = ScoreCache('molnet/score_cache.sqlite3')
+
+LIBRARY_STORE = 'molnet/matched_mibig_gnps.mlib'
+
 def get_ms2_peaks(token, host, analysis_id, as_dataframe=False):
     url = 'http://{}/export/get_ms2_peaks?analysis_id={}&as_dataframe={}'.format(host, analysis_id, as_dataframe)
     payload = get_data(token, url, as_dataframe)
@@ -85,7 +94,7 @@ def load_clusters(spectrum_list, similarity_tolerance, min_match, score_threshol
         cluster_list.append(cluster)
         
     
-    f, mol_fam = mol_network(cluster_list, fast_cosine_shift, similarity_tolerance, min_match, score_threshold, k=10, beta=100, mc=1, max_shift = 100)
+    f, mol_fam = mol_network(cluster_list, fast_cosine_shift, similarity_tolerance, min_match, score_threshold, k=10, beta=100, mc=1, max_shift = 100, score_cache=score_cache)
     
     
     return cluster_list, mol_fam
@@ -111,6 +120,10 @@ def edges_dataframe(mol_fam):
 # spectra libraries
 # =============================================================================
 def load_spectra_lib():
+    # the memory mapped store (python -m molnet.library_store molnet/matched_mibig_gnps.p
+    # molnet/matched_mibig_gnps.mlib) opens in milliseconds, use it when it is there
+    if os.path.exists(os.path.join(LIBRARY_STORE, 'store.json')):
+        return open_library_store(LIBRARY_STORE)
 #    sys.path.append("C:/Users/Shimin/Documents/UoG/MSc Dissertation/mnet/Workspace/molnet_project/molnet")
     sys.path.append("./molnet")
     with open("molnet/matched_mibig_gnps.p", 'r') as f:
@@ -0,0 +1,174 @@
+# =============================================================================
+# Writing the node, edge and MGF files of a molecular network
+#
+# tables = network_tables(molecular_families,metadata = metadata)
+# export_network(molecular_families,'results',table_format = 'csv',concurrent = True)
+#
+# network_tables walks the families once and collects the node table (a
+# column per heading), the edge table and the clusters to write to the MGF
+# file. The tables are written in bulk through large file buffers, as csv
+# (the files write_mnet_files has always written) or, where pandas is
+# installed, as parquet or feather. The MGF file goes through
+# mgf.MGFWriter. With concurrent = True the three files are written by
+# separate threads, so that the writes of one overlap the formatting of the
+# others.
+# =============================================================================
+
+from __future__ import print_function
+
+import csv
+
+from molnet.mgf import MGFWriter
+
+BUFFER_SIZE = 1<<22
+TABLE_FORMATS = ('csv','parquet','feather')
+NODE_HEADS = ['cid','familyid','precursor_mz','parent_mz','short_precursor_mz','short_parent_mz','charge','members','n_unique_files']
+EDGE_HEADS = ['source','target','weight']
+
+
+class ExportTables(object):
+    # The node table (heads and a list of columns in the same order), the
+    # edge rows and the (family id,cluster) pairs of a network
+    def __init__(self,heads,columns,edges,clusters):
+        self.heads = heads
+        self.columns = columns
+        self.edges = edges
+        self.clusters = clusters
+
+    def node_rows(self):
+        return zip(*self.columns)
+
+    def __len__(self):
+        return len(self.clusters)
+
+
+def network_tables(molecular_families,metadata = None,extra_node_data = None):
+    # metadata and extra_node_data as for mnet.write_mnet_files
+    clusters = []
+    file_counts = []
+    edges = []
+    for family in molecular_families:
+        for cluster in family.clusters:
+            clusters.append((family.family_id,cluster))
+            file_counts.append(cluster.file_stats()[0])
+        scores = family.scores
+        if len(scores) > 0:
+            edges += [(node1.cluster_id,node2.cluster_id,weight) for node1,node2,weight in scores]
+        else:
+            # Singleton family -- write the self loop
+            assert len(family.clusters) == 1
+            cluster = family.clusters[0]
+            edges.append((cluster.cluster_id,cluster.cluster_id,'self'))
+
+    unique_files = set()
+    for counts in file_counts:
+        unique_files.update(counts.keys())
+    unique_files = sorted(list(unique_files))
+
+    precursor_mz = [cluster.precursor_mz for family_id,cluster in clusters]
+    parent_mz = [cluster.parent_mz for family_id,cluster in clusters]
+    columns = [
+        [cluster.cluster_id for family_id,cluster in clusters],
+        [family_id for family_id,cluster in clusters],
+        precursor_mz,
+        parent_mz,
+        ["{:.2f}".format(mz) for mz in precursor_mz],
+        ["{:.2f}".format(mz) for mz in parent_mz],
+        [cluster.spectrum.ms1.charge for family_id,cluster in clusters],
+        [cluster.member_string() for family_id,cluster in clusters],
+        [len(counts) for counts in file_counts],
+    ]
+    heads = NODE_HEADS + unique_files
+    columns += [[counts.get(file_name,0) for counts in file_counts] for file_name in unique_files]
+    if metadata:
+        for mlist,mdict,mtitle in metadata:
+            heads = heads + mlist + [mtitle]
+            # counts,nnz of each cluster, turned into a column per item
+            rows = [cluster.n_metadata_in_cluster(mlist,mdict) for family_id,cluster in clusters]
+            columns += [[counts[pos] for counts,nnz in rows] for pos in range(len(mlist))]
+            columns.append([nnz for counts,nnz in rows])
+    if extra_node_data:
+        for names,values in extra_node_data:
+            heads = heads + names
+            rows = [values[cluster.cluster_id] for family_id,cluster in clusters]
+            columns += [[row[pos] for row in rows] for pos in range(len(names))]
+    return ExportTables(heads,columns,edges,clusters)
+
+
+def write_csv(file_name,heads,rows,buffer_size = BUFFER_SIZE):
+    with open(file_name,'w',buffering = buffer_size) as f:
+        writer = csv.writer(f)
+        writer.writerow(heads)
+        writer.writerows(rows)
+
+
+def write_frame(file_name,heads,rows,table_format):
+    import pandas as pd
+    frame = pd.DataFrame(list(rows),columns = heads)
+    if table_format == 'parquet':
+        frame.to_parquet(file_name,index = False)
+    else:
+        frame.to_feather(file_name)
+
+
+def edge_frame_rows(edges):
+    # parquet and feather columns have one type: the weights of self loops
+    # are nan, marked in an extra column
+    return [(source,target,float('nan') if weight == 'self' else weight,weight == 'self') for source,target,weight in edges]
+
+
+def write_mgf_file(mgf_file,clusters,buffer_size = BUFFER_SIZE):
+    with open(mgf_file,'w') as f:
+        with MGFWriter(f,buffer_size = buffer_size) as writer:
+            for family_id,cluster in clusters:
+                spectrum = cluster.spectrum
+                writer.write([('FILENAME',spectrum.file_name),
+                              ('SCANNO',spectrum.scan_number),
+                              ('CID',cluster.cluster_id),
+                              ('FAMILYID',family_id),
+                              ('PEPMASS',spectrum.precursor_mz),
+                              ('RTINSECONDS',spectrum.rt),
+                              ('CHARGE',spectrum.ms1.charge),
+                              ('NAME',cluster.cluster_id)],spectrum.peaks)
+            return writer.n_written
+
+
+def export_network(molecular_families,file_name,metadata = None,write_mgf = True,extra_node_data = None,
+        table_format = 'csv',concurrent = False,buffer_size = BUFFER_SIZE):
+    # Write file_name + '_nodes.csv', '_edges.csv' (or .parquet / .feather)
+    # and '.mgf', returning the names of the files written
+    if not table_format in TABLE_FORMATS:
+        raise ValueError("Unknown table format {}, expected one of {}".format(table_format,", ".join(TABLE_FORMATS)))
+    if table_format != 'csv':
+        try:
+            import pandas
+        except ImportError:
+            print("pandas is not installed, writing csv tables instead of {}".format(table_format))
+            table_format = 'csv'
+    tables = network_tables(molecular_families,metadata = metadata,extra_node_data = extra_node_data)
+
+    node_file = file_name + '_nodes.' + table_format
+    edge_file = file_name + '_edges.' + table_format
+    if table_format == 'csv':
+        jobs = [(write_csv,(node_file,tables.heads,tables.node_rows(),buffer_size)),
+                (write_csv,(edge_file,EDGE_HEADS,tables.edges,buffer_size))]
+    else:
+        jobs = [(write_frame,(node_file,tables.heads,tables.node_rows(),table_format)),
+                (write_frame,(edge_file,EDGE_HEADS + ['self_loop'],edge_frame_rows(tables.edges),table_format))]
+    written = [node_file,edge_file]
+    if write_mgf:
+        jobs.append((write_mgf_file,(file_name + '.mgf',tables.clusters,buffer_size)))
+        written.append(file_name + '.mgf')
+
+    print("Writing {} nodes, {} edges{}".format(len(tables),len(tables.edges)," and mgf" if write_mgf else ""))
+    if concurrent:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers = len(jobs)) as executor:
+            futures = [executor.submit(function,*args) for function,args in jobs]
+            # raises the first error, if any
+            for future in futures:
+                future.result()
+    else:
+        for function,args in jobs:
+            function(*args)
+    return written
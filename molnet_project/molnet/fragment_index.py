@@ -0,0 +1,77 @@
+# =============================================================================
+# Inverted index from binned fragment m/z (and neutral loss) to spectra, used
+# to generate the candidate pairs for network construction
+# =============================================================================
+
+from __future__ import print_function
+
+import numpy as np
+
+# Two peaks can only match if their m/z values (or, for the shifted match,
+# their neutral losses) are within tol, so their bins of width tol differ by
+# at most one. The bins are made a fraction wider than tol so that rounding
+# in the neutral loss can't push a matching pair two bins apart.
+BIN_SLACK = 1e-6
+
+
+class FragmentIndex(object):
+    # Index over the spectra of a PackedSpectra block (normally sorted by
+    # parent m/z, see make_initial_network). Each peak is entered under the
+    # bin of its m/z and, if use_losses, under the bin of its neutral loss
+    # (parent m/z - peak m/z). The postings are sorted by (bin, spectrum
+    # position) so that the postings of a bin within a range of spectrum
+    # positions are a contiguous slice.
+    def __init__(self,packed,tol,use_losses = True):
+        self.n_spectra = len(packed)
+        self.width = tol*(1 + BIN_SLACK) + BIN_SLACK
+        self.use_losses = use_losses
+        owner = np.repeat(np.arange(self.n_spectra,dtype = np.int64),packed.n_peaks())
+        self.fragment_keys = self._sorted_keys(self._bins(packed.mz),owner)
+        if use_losses:
+            losses = packed.parent_mz[owner] - packed.mz
+            self.loss_keys = self._sorted_keys(self._bins(losses),owner)
+
+    def _bins(self,values):
+        return np.floor(values/self.width).astype(np.int64)
+
+    def _sorted_keys(self,bins,owner):
+        # bin*n_spectra + owner, sorted, so a bin holds the key range
+        # [bin*n_spectra,(bin+1)*n_spectra)
+        return np.sort(bins*self.n_spectra + owner)
+
+    def _hits(self,keys,query_bins,start,end):
+        # (query peak, spectrum position) for every posting in the bins
+        # next to each query bin with start <= position < end
+        n_query = len(query_bins)
+        lows = []
+        highs = []
+        for offset in (-1,0,1):
+            base = (query_bins + offset)*self.n_spectra
+            lows.append(np.searchsorted(keys,base + start,side = 'left'))
+            highs.append(np.searchsorted(keys,base + end,side = 'left'))
+        lows = np.concatenate(lows)
+        highs = np.concatenate(highs)
+        peak = np.tile(np.arange(n_query),3)
+        counts = highs - lows
+        total = counts.sum()
+        peak = np.repeat(peak,counts)
+        run_start = np.cumsum(counts) - counts
+        posting = np.repeat(lows - run_start,counts) + np.arange(total)
+        return peak,keys[posting] % self.n_spectra
+
+    def candidates(self,mz,parent_mz,start,end,min_shared):
+        # Positions in start..end-1 of the spectra that share a fragment
+        # (or neutral loss) bin with at least min_shared distinct peaks of a
+        # query with peak m/z values mz. A spectrum that can match k peaks of
+        # the query within the tolerance shares bins with at least k of them.
+        if end <= start or len(mz) == 0:
+            return np.zeros(0,dtype = np.int64)
+        peak,owner = self._hits(self.fragment_keys,self._bins(mz),start,end)
+        if self.use_losses:
+            loss_peak,loss_owner = self._hits(self.loss_keys,self._bins(parent_mz - mz),start,end)
+            peak = np.concatenate((peak,loss_peak))
+            owner = np.concatenate((owner,loss_owner))
+        # count each query peak once per spectrum
+        pairs = np.unique(owner*len(mz) + peak)
+        owners,n_shared = np.unique(pairs//len(mz),return_counts = True)
+        return owners[n_shared >= max(min_shared,1)]
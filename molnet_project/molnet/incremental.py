@@ -0,0 +1,189 @@
+# =============================================================================
+# Incremental molecular networking: keep a network (the scored edges before
+# the top-k filter, the top-k sets and the families) and add new clusters to
+# it, scoring only the pairs involving them and rebuilding only the families
+# they touch
+# =============================================================================
+
+from __future__ import print_function
+
+import numpy as np
+
+from molnet.mnet import CSRGraph,MolecularFamily,score_pairs
+from molnet.scoring_functions import pack_spectra,concatenate_packed,score_block,get_score_function,BATCH_FUNCTIONS,BATCH_SHIFT
+
+
+class IncrementalNetwork(object):
+    # The network of mol_network(...,compact_graph = True) for the clusters
+    # added so far, in the order they were added: after add_clusters the
+    # families are the same as running mol_network on all of the clusters.
+    # Families that new clusters don't touch keep their family_id; the
+    # rebuilt ones get new ids.
+    def __init__(self,similarity_function,similarity_tolerance,min_match,score_threshold,k = 10,beta = 100,mc = 1,max_shift = 100):
+        self.similarity_function = similarity_function
+        self.similarity_tolerance = similarity_tolerance
+        self.min_match = min_match
+        self.score_threshold = score_threshold
+        self.k = k
+        self.beta = beta
+        self.mc = mc
+        self.max_shift = max_shift
+
+        self.clusters = [] # node id -> cluster
+        self.neighbours = [] # node id -> {node id: score} of the edges reaching score_threshold
+        self.top = [] # node id -> set of the (at most k) node ids of its strongest edges
+        self.component_of = [] # node id -> component (of the top-k network, before beta splitting)
+        self.components = {} # component -> list of node ids
+        self.family_of = [] # node id -> family_id
+        self.families = {} # family_id -> (family graph, MolecularFamily)
+        self.next_component = 0
+        self.next_family_id = 0
+        self.packed = pack_spectra([])
+
+    @classmethod
+    def from_score_matrix(cls,matrix,cluster_list,similarity_function,score_threshold,k = 10,beta = 100):
+        # start from a ScoreMatrix (see mnet.score_matrix) computed with
+        # similarity_function and a score_floor of at most score_threshold
+        parameters = matrix.parameters
+        if parameters['similarity_function'] != similarity_function.__name__:
+            raise ValueError("The matrix was scored with {}".format(parameters['similarity_function']))
+        if score_threshold < parameters['score_floor']:
+            raise ValueError("score_threshold {} is below the score floor of the matrix ({})".format(
+                score_threshold,parameters['score_floor']))
+        network = cls(similarity_function,parameters['similarity_tolerance'],parameters['min_match'],score_threshold,
+            k = k,beta = beta,mc = parameters['mc'],max_shift = parameters['max_shift'])
+        clusters_by_id = dict([(c.cluster_id,c) for c in cluster_list])
+        keep = np.flatnonzero(matrix.scores >= score_threshold)
+        edges = zip(matrix.rows[keep].tolist(),matrix.cols[keep].tolist(),matrix.scores[keep].tolist())
+        network._add([clusters_by_id[cluster_id] for cluster_id in matrix.cluster_ids],edges)
+        return network
+
+    def build(self,cluster_list,n_jobs = 1,score_cache = None):
+        # the network of an initial list of clusters, scored as mol_network
+        # would (in parallel and with a cache if asked)
+        filtered_cluster_list,edges = score_pairs(cluster_list,self.similarity_function,self.similarity_tolerance,self.min_match,self.score_threshold,
+            mc = self.mc,max_shift = self.max_shift,n_jobs = n_jobs,score_cache = score_cache)
+        self._add(filtered_cluster_list,edges)
+        return self.final_families()
+
+    def add_clusters(self,new_clusters):
+        # Add clusters (new spectra as clusters) to the network: they are
+        # scored against all the clusters in it and each other, then top-k,
+        # components and beta splitting are redone for the families whose
+        # clusters gain or lose edges. Returns the families as
+        # final_families() does.
+        new_clusters = list(filter(lambda x: len(x.spectra) >= self.mc,new_clusters))
+        n_old = len(self.clusters)
+        print("Scoring {} new clusters against {}".format(len(new_clusters),n_old))
+        packed = concatenate_packed([self.packed,pack_spectra(new_clusters)])
+        batch_function = BATCH_FUNCTIONS.get(self.similarity_function,None)
+        score_function = None if batch_function else get_score_function(self.similarity_function)
+        edges = []
+        for q in range(n_old,n_old + len(new_clusters)):
+            # pairs with the clusters before it (old, then earlier new ones),
+            # which are spectrum 1 as in a double loop over the whole list
+            parent_mz = packed.parent_mz[q]
+            candidates = np.flatnonzero(np.abs(packed.parent_mz[:q] - parent_mz) < self.max_shift)
+            if len(candidates) == 0:
+                continue
+            if batch_function:
+                mz,intensity = packed.spectrum_arrays(q)
+                scores = score_block(mz,intensity,parent_mz,packed.take(candidates),self.similarity_tolerance,self.min_match,
+                    shift = BATCH_SHIFT[batch_function],query_first = False,score_threshold = self.score_threshold)
+            else:
+                cluster = new_clusters[q - n_old]
+                scores = [score_function(self.clusters[p] if p < n_old else new_clusters[p - n_old],cluster,self.similarity_tolerance,self.min_match)
+                    for p in candidates.tolist()]
+            for p,score in zip(candidates.tolist(),scores):
+                if score >= self.score_threshold:
+                    edges.append((p,q,float(score)))
+        self.packed = packed
+        self._add(new_clusters,edges,packed = True)
+        return self.final_families()
+
+    def final_families(self):
+        # (family graphs, MolecularFamily objects) in family_id order, as
+        # mol_network returns them
+        family_ids = sorted(self.families.keys())
+        return [self.families[f][0] for f in family_ids],[self.families[f][1] for f in family_ids]
+
+    def top_neighbours(self,i):
+        # the k strongest edges of node i, ties broken as CSRGraph orders
+        # them (later nodes first, then by node id)
+        ranked = sorted(self.neighbours[i].items(),key = lambda x: (-x[1],x[0] < i,x[0]))
+        return set([j for j,score in ranked[:self.k]])
+
+    def mutual_neighbours(self,i):
+        # the neighbours of node i in the top-k filtered network
+        return [j for j in self.top[i] if i in self.top[j]]
+
+    def _add(self,clusters,edges,packed = False):
+        # add clusters (node ids following on from the existing ones) and
+        # edges (i,j,score) with i < j, then update the families
+        n_old = len(self.clusters)
+        self.clusters += clusters
+        if not packed:
+            self.packed = concatenate_packed([self.packed,pack_spectra(clusters)])
+        for c in clusters:
+            self.neighbours.append({})
+            self.top.append(set())
+            self.component_of.append(None)
+            self.family_of.append(None)
+        affected = set(range(n_old,len(self.clusters)))
+        for i,j,score in edges:
+            self.neighbours[i][j] = score
+            self.neighbours[j][i] = score
+            affected.add(i)
+            affected.add(j)
+
+        # top-k only changes for nodes with new edges; the components that
+        # may change are those of these nodes and of their top-k neighbours
+        # before and after
+        region_nodes = set()
+        old_neighbours = dict([(i,self.mutual_neighbours(i)) for i in affected])
+        for i in affected:
+            self.top[i] = self.top_neighbours(i)
+        touched = set(affected)
+        for i in affected:
+            touched.update(old_neighbours[i])
+            touched.update(self.mutual_neighbours(i))
+        old_components = set([self.component_of[i] for i in touched if self.component_of[i] is not None])
+        old_families = set()
+        for component in old_components:
+            for i in self.components.pop(component):
+                region_nodes.add(i)
+                old_families.add(self.family_of[i])
+        region_nodes.update(touched)
+        for family_id in old_families:
+            del self.families[family_id]
+        self._rebuild(sorted(region_nodes))
+
+    def _rebuild(self,region_nodes):
+        # components and beta splitting of the top-k network on region_nodes
+        # (a union of whole components), as split_families does them
+        local = dict([(i,pos) for pos,i in enumerate(region_nodes)])
+        rows = []
+        cols = []
+        weights = []
+        for pos,i in enumerate(region_nodes):
+            for j in sorted(self.mutual_neighbours(i)):
+                if j > i:
+                    rows.append(pos)
+                    cols.append(local[j])
+                    weights.append(self.neighbours[i][j])
+        G = CSRGraph.from_edges([self.clusters[i] for i in region_nodes],rows,cols,weights)
+        index = G.node_index()[1]
+        for component in G.connected_components():
+            component_id = self.next_component
+            self.next_component += 1
+            members = [region_nodes[index[c]] for c in component.nodes]
+            self.components[component_id] = members
+            for i in members:
+                self.component_of[i] = component_id
+            parts = [component] if len(component) <= self.beta else component.split(self.beta)
+            for part in parts:
+                family_id = self.next_family_id
+                self.next_family_id += 1
+                self.families[family_id] = (part,MolecularFamily(part,family_id))
+                for c in part.nodes:
+                    self.family_of[region_nodes[index[c]]] = family_id
@@ -0,0 +1,273 @@
+# =============================================================================
+# Columnar spectral library store, opened through numpy memory maps
+#
+# python -m molnet.library_store matched_mibig_gnps.p matched_mibig_gnps.mlib
+# python -m molnet.library_store library.mgf library.mlib --id_field SPECTRUMID
+#
+# library = open_library_store('matched_mibig_gnps.mlib')
+# hits = library.spectral_match(query) # as SpecLib.spectral_match
+#
+# A store is a directory of .npy columns with the spectra sorted by precursor
+# m/z: the peaks of spectrum i are mz[offsets[i]:offsets[i+1]] (and the same
+# slice of intensity and of the sqrt normalised intensity used for scoring),
+# precursor_mz is the sorted index searched for candidates and ids holds the
+# spectrum ids. The rest of the metadata is a json table that is only read
+# when spectra are built from the store. Opening a store maps the columns
+# without reading them, and processes that open the same store share their
+# pages.
+# =============================================================================
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import numpy as np
+
+from molnet.mnet import CompactSpectrum,Annotation
+from molnet.scoring_functions import PackedSpectra,normalised_arrays,fast_cosine,BATCH_FUNCTIONS
+
+STORE_VERSION = 1
+COLUMNS = ('ids','mz','intensity','normalised_intensity','offsets','precursor_mz','parent_mz')
+
+
+def write_library_store(spectra,store_dir,dtype = np.float64,source = None):
+    # Write (spectrum id,spectrum) pairs (or a dict of them, as
+    # SpecLib.spectra) to a new store in the directory store_dir. Raw
+    # intensities are kept as dtype; the normalised ones are always float64
+    # so that scores are the same as from the spectra themselves.
+    if isinstance(spectra,dict):
+        spectra = spectra.items()
+    ids = []
+    mz_list = []
+    intensity_list = []
+    normalised_list = []
+    precursor_mz = []
+    parent_mz = []
+    records = []
+    for spectrum_id,spectrum in spectra:
+        prototype = getattr(spectrum,'spectrum',spectrum)
+        peaks = prototype.peaks
+        ids.append(str(spectrum_id))
+        mz_list.append(np.array([p[0] for p in peaks],dtype = np.float64))
+        intensity_list.append(np.array([p[1] for p in peaks],dtype = dtype))
+        normalised_list.append(normalised_arrays(prototype)[1])
+        precursor_mz.append(prototype.precursor_mz)
+        parent_mz.append(prototype.parent_mz)
+        records.append(spectrum_record(prototype))
+    order = np.argsort(np.array(precursor_mz,dtype = np.float64),kind = 'mergesort')
+    n_peaks = np.array([len(mz_list[i]) for i in order],dtype = np.int64)
+    offsets = np.zeros(len(order)+1,dtype = np.int64)
+    np.cumsum(n_peaks,out = offsets[1:])
+
+    def joined(arrays,array_dtype):
+        return np.concatenate([np.zeros(0,dtype = array_dtype)] + [arrays[i] for i in order]).astype(array_dtype)
+
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    columns = {
+        'ids': np.array([ids[i] for i in order],dtype = np.str_) if ids else np.zeros(0,dtype = '<U1'),
+        'mz': joined(mz_list,np.float64),
+        'intensity': joined(intensity_list,dtype),
+        'normalised_intensity': joined(normalised_list,np.float64),
+        'offsets': offsets,
+        'precursor_mz': np.array([precursor_mz[i] for i in order],dtype = np.float64),
+        'parent_mz': np.array([parent_mz[i] for i in order],dtype = np.float64),
+    }
+    for name in COLUMNS:
+        np.save(os.path.join(store_dir,name + '.npy'),columns[name])
+    with open(os.path.join(store_dir,'metadata.json'),'w') as f:
+        json.dump([records[i] for i in order],f)
+    # written last: a store without it is incomplete
+    with open(os.path.join(store_dir,'store.json'),'w') as f:
+        json.dump({'version': STORE_VERSION,'n_spectra': len(order),'n_peaks': int(offsets[-1]),
+            'intensity_dtype': np.dtype(dtype).name,'source': source},f)
+    return len(order)
+
+
+def spectrum_record(spectrum):
+    # the fields of a spectrum other than its peaks, as json
+    metadata = {}
+    for key,value in (spectrum.metadata or {}).items():
+        if key == 'annotation':
+            value = [a.metadata for a in value]
+        try:
+            json.dumps(value)
+        except (TypeError,ValueError):
+            continue
+        metadata[key] = value
+    ms1 = spectrum.ms1
+    record = {'file_name': spectrum.file_name,'scan_number': spectrum.scan_number,'rt': spectrum.rt,
+        'precursor_intensity': spectrum.precursor_intensity,'charge': getattr(ms1,'charge',None),
+        'metadata': metadata}
+    for attr in ('spectrumid','name'):
+        if hasattr(spectrum,attr):
+            record[attr] = getattr(spectrum,attr)
+    # numpy scalars as plain numbers, anything else json can't take as text
+    return json.loads(json.dumps(record,default = lambda x: x.item() if hasattr(x,'item') else str(x)))
+
+
+class StorePrecursor(object):
+    # stands in for the MS1 object of a stored spectrum (Spectrum.ms1)
+    def __init__(self,mz,charge = None,name = None):
+        self.mz = mz
+        self.charge = charge
+        self.name = name
+
+
+class LibraryStore(object):
+    # An opened store, usable in place of a SpecLib: spectral_match and the
+    # spectra mapping (spectrum id -> CompactSpectrum, built on access)
+    def __init__(self,store_dir,mmap = True):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir,'store.json'),'r') as f:
+            self.info = json.load(f)
+        if self.info['version'] != STORE_VERSION:
+            raise ValueError("{} is a version {} store, expected {}".format(store_dir,self.info['version'],STORE_VERSION))
+        mmap_mode = 'r' if mmap else None
+        for name in COLUMNS:
+            setattr(self,name,np.load(os.path.join(store_dir,name + '.npy'),mmap_mode = mmap_mode))
+        self._records = None
+        self._positions = None
+        self.spectra = StoreSpectra(self)
+
+    def __len__(self):
+        return len(self.precursor_mz)
+
+    def get_n_spec(self):
+        return len(self)
+
+    def get_keys(self):
+        return self.ids.tolist()
+
+    def get_n_peaks(self):
+        return np.diff(self.offsets).tolist()
+
+    def records(self):
+        # the metadata table, read the first time it is needed
+        if self._records is None:
+            with open(os.path.join(self.store_dir,'metadata.json'),'r') as f:
+                self._records = json.load(f)
+        return self._records
+
+    def position(self,spectrum_id):
+        if self._positions is None:
+            self._positions = dict([(spectrum_id,pos) for pos,spectrum_id in enumerate(self.ids.tolist())])
+        return self._positions[spectrum_id]
+
+    def packed(self):
+        # all the spectra as a PackedSpectra block on the mapped columns
+        return PackedSpectra(self.mz,self.normalised_intensity,self.offsets,self.parent_mz)
+
+    def candidate_range(self,precursor_mz,ms1_tol):
+        # the positions start..end-1 of the spectra with precursor m/z in
+        # (precursor_mz - ms1_tol,precursor_mz + ms1_tol], as SpecLib finds them
+        start = int(np.searchsorted(self.precursor_mz,precursor_mz - ms1_tol,side = 'right'))
+        end = int(np.searchsorted(self.precursor_mz,precursor_mz + ms1_tol,side = 'right'))
+        return start,end
+
+    def get_spectrum(self,pos):
+        # the spectrum at position pos as a CompactSpectrum (with its own
+        # copy of the peaks)
+        lo,hi = self.offsets[pos],self.offsets[pos+1]
+        record = self.records()[pos]
+        metadata = dict(record['metadata'])
+        if 'annotation' in metadata:
+            metadata['annotation'] = [Annotation(a) for a in metadata['annotation']]
+        precursor_mz = float(self.precursor_mz[pos])
+        spectrum = CompactSpectrum((np.array(self.mz[lo:hi]),np.array(self.intensity[lo:hi])),record['file_name'],
+            record['scan_number'],StorePrecursor(precursor_mz,charge = record['charge'],name = record.get('name',None)),
+            precursor_mz,float(self.parent_mz[pos]),rt = record['rt'],precursor_intensity = record['precursor_intensity'],
+            metadata = metadata,dtype = self.intensity.dtype)
+        spectrum.spectrum_id = str(self.ids[pos])
+        for attr in ('spectrumid','name'):
+            if attr in record:
+                setattr(spectrum,attr,record[attr])
+        return spectrum
+
+    def spectral_match(self,query,
+            scoring_function = fast_cosine,
+            ms2_tol = 0.2,
+            min_match_peaks = 1,
+            ms1_tol = 0.2,
+            score_thresh = 0.7,
+            stats = None):
+        # the (spectrum id,score) of the library spectra matching query, as
+        # SpecLib.spectral_match gives them
+        start,end = self.candidate_range(query.precursor_mz,ms1_tol)
+        hits = []
+        batch_function = BATCH_FUNCTIONS.get(scoring_function,None)
+        if batch_function:
+            scores = batch_function(query,self.packed().slice(start,end),ms2_tol,min_match_peaks,
+                score_threshold = score_thresh,stats = stats).tolist()
+        else:
+            scores = [scoring_function(query,self.get_spectrum(pos),ms2_tol,min_match_peaks)[0] for pos in range(start,end)]
+        for pos,sc in zip(range(start,end),scores):
+            if sc >= score_thresh:
+                hits.append((str(self.ids[pos]),sc))
+        return hits
+
+
+class StoreSpectra(Mapping):
+    # spectrum id -> CompactSpectrum for the spectra of a LibraryStore
+    def __init__(self,store):
+        self.store = store
+
+    def __getitem__(self,spectrum_id):
+        return self.store.get_spectrum(self.store.position(spectrum_id))
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self,spectrum_id):
+        try:
+            self.store.position(spectrum_id)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.store.ids.tolist())
+
+
+def open_library_store(store_dir,mmap = True):
+    return LibraryStore(store_dir,mmap = mmap)
+
+
+def load_library(file_name,id_field = 'SPECTRUMID'):
+    # the spectra (a dict of id -> spectrum) of a jsonpickled SpecLib or an
+    # MGF file
+    if file_name.lower().endswith('.mgf'):
+        from molnet.mgf import load_mgf
+        return load_mgf(file_name,id_field = id_field)
+    import jsonpickle
+    # older pickles refer to the modules by their names inside molnet
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    with open(file_name,'r') as f:
+        library = jsonpickle.decode(f.read())
+    return library.spectra if hasattr(library,'spectra') else library
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Convert a jsonpickled SpecLib or an MGF library to a molnet library store')
+    parser.add_argument('input',help = 'a jsonpickle (.p) or .mgf library')
+    parser.add_argument('output',help = 'the store directory to write')
+    parser.add_argument('--id_field',default = 'SPECTRUMID',help = 'the MGF field holding the spectrum ids')
+    parser.add_argument('--dtype',default = 'float64',choices = ['float64','float32'],help = 'dtype of the stored raw intensities')
+    args = parser.parse_args(argv)
+
+    spectra = load_library(args.input,id_field = args.id_field)
+    n_spectra = write_library_store(spectra,args.output,dtype = np.dtype(args.dtype),source = os.path.basename(args.input))
+    print("Wrote {} spectra to {}".format(n_spectra,args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
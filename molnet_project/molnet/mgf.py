@@ -0,0 +1,239 @@
+# =============================================================================
+# Reading and writing MGF files one spectrum at a time
+#
+# for spectrum_id,spectrum in read_mgf('library.mgf',id_field = 'SPECTRUMID'):
+#     ...
+#
+# read_mgf reads the file in fixed size chunks and yields the spectra as it
+# finds them, so memory use doesn't grow with the file. The peak block of
+# each spectrum is converted in one go by numpy. MGFWriter collects the text of
+# the spectra it is given and writes it out in large blocks.
+# =============================================================================
+
+from __future__ import print_function
+
+import re
+
+import numpy as np
+
+from molnet.mnet import Spectrum,CompactSpectrum
+
+CHUNK_SIZE = 1<<22
+PEAK_LINE = re.compile(br'^[ \t]*[-+.0-9][^=\n]*$',re.M)
+
+
+# The precursor ion of an MGF spectrum, which stands in for the MS1 peak
+# objects of the mzML loaders (Spectrum.ms1)
+class MGFPrecursor(object):
+    def __init__(self,mz,intensity = None,charge = None,rt = None,name = None):
+        self.mz = mz
+        self.intensity = intensity
+        self.charge = charge
+        self.rt = rt
+        self.name = name
+
+    def __str__(self):
+        return "Precursor {} (charge {}) at {}".format(self.mz,self.charge,self.rt)
+
+
+def parse_charge(charge):
+    # MGF charges look like 1+, 2- or 1
+    charge = charge.strip()
+    if not charge:
+        return None
+    sign = -1 if charge.endswith('-') else 1
+    try:
+        return sign*int(charge.rstrip('+-'))
+    except ValueError:
+        return None
+
+
+def parse_peaks(block):
+    # (mz,intensity) float64 arrays from the peak lines of a spectrum
+    tokens = block.split()
+    try:
+        values = np.array(tokens,dtype = np.float64)
+    except ValueError:
+        values = None
+    if values is None or len(tokens) != 2*(block.count(b'\n') + 1):
+        # blank lines, extra columns or junk: go line by line
+        values = []
+        for line in block.split(b'\n'):
+            tokens = line.split()
+            if len(tokens) >= 2:
+                values += [float(tokens[0]),float(tokens[1])]
+        values = np.array(values,dtype = np.float64)
+    return values[0::2],values[1::2]
+
+
+def parse_record(record):
+    # the metadata (lower case keys) and peak arrays of the text between
+    # BEGIN IONS and END IONS: the fields, then the peaks from the first
+    # line that looks like one
+    peak_line = PEAK_LINE.search(record)
+    if peak_line:
+        header,block = record[:peak_line.start()],record[peak_line.start():].strip()
+    else:
+        header,block = record,b''
+    metadata = {}
+    for line in header.decode('utf-8','replace').split('\n'):
+        if '=' in line:
+            key,value = line.strip().split('=',1)
+            metadata[key.lower()] = value
+    if block:
+        mz,intensity = parse_peaks(block)
+    else:
+        mz,intensity = np.zeros(0),np.zeros(0)
+    return metadata,mz,intensity
+
+
+def iter_records(mgf_file,chunk_size = CHUNK_SIZE):
+    # the (metadata,mz,intensity) of each spectrum in the file, reading it
+    # chunk_size bytes at a time
+    with open(mgf_file,'rb') as f:
+        buffer = b''
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            pos = 0
+            while True:
+                start = buffer.find(b'BEGIN IONS',pos)
+                if start == -1:
+                    # keep what could be the start of a split BEGIN IONS
+                    pos = max(pos,len(buffer) - len(b'BEGIN IONS'))
+                    break
+                end = buffer.find(b'END IONS',start)
+                if end == -1:
+                    pos = start
+                    break
+                yield parse_record(buffer[start + len(b'BEGIN IONS'):end])
+                pos = end + len(b'END IONS')
+            buffer = buffer[pos:]
+            if not chunk:
+                break
+
+
+def make_spectrum(metadata,mz,intensity,file_name,compact = False):
+    # a Spectrum (or CompactSpectrum) from a parsed MGF record. parent_mz is
+    # the precursor m/z, as for the other loaders.
+    precursor = metadata.get('pepmass','0').split()
+    precursor_mz = float(precursor[0])
+    precursor_intensity = float(precursor[1]) if len(precursor) > 1 else None
+    rt = float(metadata['rtinseconds']) if metadata.get('rtinseconds','').strip() not in ('','None') else None
+    ms1 = MGFPrecursor(precursor_mz,intensity = precursor_intensity,charge = parse_charge(metadata.get('charge','')),
+        rt = rt,name = metadata.get('name',None))
+    scan_number = metadata.get('scans',None)
+    if compact:
+        return CompactSpectrum((mz,intensity),file_name,scan_number,ms1,precursor_mz,precursor_mz,
+            rt = rt,precursor_intensity = precursor_intensity,metadata = metadata)
+    return Spectrum(list(zip(mz.tolist(),intensity.tolist())),file_name,scan_number,ms1,precursor_mz,precursor_mz,
+        rt = rt,precursor_intensity = precursor_intensity,metadata = metadata)
+
+
+def read_mgf(mgf_file,id_field = 'SPECTRUMID',pipeline = None,batch_size = 1000,compact = False,chunk_size = CHUNK_SIZE):
+    # Yield (spectrum id,spectrum) for the spectra in an MGF file, the id
+    # being the id_field of each (records without it, or without peaks, are
+    # skipped). If a preprocessing.Pipeline is given it is applied to
+    # batch_size spectra at a time as they are read; spectra it leaves
+    # without peaks are skipped too.
+    id_field = id_field.lower()
+    batch = []
+    for metadata,mz,intensity in iter_records(mgf_file,chunk_size = chunk_size):
+        if len(mz) == 0 or not id_field in metadata:
+            continue
+        spectrum = make_spectrum(metadata,mz,intensity,mgf_file,compact = compact)
+        if pipeline is None:
+            yield metadata[id_field],spectrum
+            continue
+        batch.append((metadata[id_field],spectrum))
+        if len(batch) == batch_size:
+            for item in _preprocess(batch,pipeline):
+                yield item
+            batch = []
+    for item in _preprocess(batch,pipeline):
+        yield item
+
+
+def _preprocess(batch,pipeline):
+    if batch:
+        pipeline.apply([spectrum for spectrum_id,spectrum in batch])
+    return [(spectrum_id,spectrum) for spectrum_id,spectrum in batch if spectrum.n_peaks > 0]
+
+
+def load_mgf(mgf_file,id_field = 'SPECTRUMID',**kwargs):
+    # all the spectra of an MGF file as a dict of spectrum id -> spectrum
+    return dict(read_mgf(mgf_file,id_field = id_field,**kwargs))
+
+
+def format_spectrum(fields,peaks):
+    # the MGF text of a spectrum: fields are (key,value) pairs in order
+    lines = ["BEGIN IONS\n"]
+    lines += ["{}={}\n".format(key,value) for key,value in fields]
+    lines += ["%s %s\n" % (mz,intensity) for mz,intensity in peaks]
+    lines.append("END IONS\n\n")
+    return "".join(lines)
+
+
+class MGFWriter(object):
+    # Buffered MGF output: the text of the spectra is collected and written
+    # to f (an open text file) whenever buffer_size characters are waiting,
+    # and when flushed or used as a context manager, on exit
+    def __init__(self,f,buffer_size = CHUNK_SIZE):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.n_written = 0
+
+    def write(self,fields,peaks):
+        text = format_spectrum(fields,peaks)
+        self.buffer.append(text)
+        self.buffered += len(text)
+        self.n_written += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.f.write("".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.flush()
+
+
+def spectrum_fields(spectrum,spectrum_id = None,id_field = 'SPECTRUMID'):
+    # the MGF fields of a spectrum: its id, precursor, charge and retention
+    # time, then any other (string) metadata it was read with
+    precursor = spectrum.precursor_mz
+    if spectrum.precursor_intensity:
+        precursor = "{} {}".format(precursor,spectrum.precursor_intensity)
+    fields = []
+    if spectrum_id is not None:
+        fields.append((id_field.upper(),spectrum_id))
+    fields.append(('PEPMASS',precursor))
+    charge = getattr(spectrum.ms1,'charge',None)
+    if charge is not None:
+        fields.append(('CHARGE',"{}{}".format(abs(charge),'-' if charge < 0 else '+')))
+    if spectrum.rt is not None:
+        fields.append(('RTINSECONDS',spectrum.rt))
+    written = set(['pepmass','charge','rtinseconds',id_field.lower()])
+    for key,value in sorted((spectrum.metadata or {}).items()):
+        if not key in written and isinstance(value,str) and not '\n' in value:
+            fields.append((key.upper(),value))
+    return fields
+
+
+def write_mgf(spectra,mgf_file,id_field = 'SPECTRUMID',buffer_size = CHUNK_SIZE):
+    # Write (spectrum id,spectrum) pairs (or a dict of them, as load_mgf
+    # returns) to an MGF file that read_mgf reads back
+    if isinstance(spectra,dict):
+        spectra = spectra.items()
+    with open(mgf_file,'w') as f:
+        with MGFWriter(f,buffer_size = buffer_size) as writer:
+            for spectrum_id,spectrum in spectra:
+                writer.write(spectrum_fields(spectrum,spectrum_id = spectrum_id,id_field = id_field),spectrum.peaks)
+            return writer.n_written
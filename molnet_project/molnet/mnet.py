@@ -9,10 +9,14 @@ import os
 #import getopt
 import math
 import bisect
+import heapq
 import pymzml
 import glob
+import numpy as np
 
-from molnet.scoring_functions import fast_cosine, fast_cosine_shift
+from molnet.scoring_functions import fast_cosine, fast_cosine_shift, get_score_function, pack_spectra, score_block, PackedSpectra, BATCH_FUNCTIONS, BATCH_SHIFT
+from molnet.fragment_index import FragmentIndex
+from molnet import score_cache as sc
 
 
 def sqrt_normalise(peaks):
@@ -27,6 +31,16 @@ def sqrt_normalise(peaks):
         normalised_peaks.append((mz,intensity/norm_facc))
     return normalised_peaks
 
+def max_intensity(peaks):
+    if len(peaks) == 0:
+        return 0.0
+    return max([intensity for mz,intensity in peaks])
+
+def total_intensity(peaks):
+    if len(peaks) == 0:
+        return 0.0
+    return sum([intensity for mz,intensity in peaks])
+
 class Annotation(object):
     def __init__(self,data_dict):
         self.metadata = data_dict
@@ -48,13 +62,18 @@ class Annotation(object):
             self.metadata.get('SpectrumID',None))
         
 # Class to hold a single spectrum and its metadata
+#
+# The fields derived from the peaks (normalised_peaks, n_peaks,
+# max_ms2_intensity and total_ms2_intensity) are worked out when first
+# needed and cached until the peaks are replaced, so chains of filters don't
+# recompute them after every step. Assign a new list to peaks rather than
+# changing it in place (or call invalidate() afterwards).
+# Spectrum.recompute_count counts the recomputations over all spectra.
 class Spectrum(object):
+    recompute_count = 0
+
     def __init__(self,peaks,file_name,scan_number,ms1,precursor_mz,parent_mz,rt = None,precursor_intensity = None,metadata = None):
         self.peaks = sorted(peaks,key = lambda x: x[0]) # ensure sorted by mz
-        self.normalised_peaks = sqrt_normalise(self.peaks) # useful later
-        self.n_peaks = len(self.peaks)
-        self.max_ms2_intensity = max([intensity for mz,intensity in self.peaks])
-        self.total_ms2_intensity = sum([intensity for mz,intensity in self.peaks])
         self.file_name = file_name
         self.scan_number = scan_number
         self.ms1 = ms1
@@ -64,6 +83,70 @@ class Spectrum(object):
         self.precursor_intensity = precursor_intensity
         self.metadata = metadata
 
+    def get_peaks(self):
+        try:
+            return self._peaks
+        except AttributeError:
+            # unpickled from before the derived fields were cached: the
+            # peaks and the (eagerly computed) fields are plain attributes
+            for name in ('normalised_peaks','n_peaks','max_ms2_intensity','total_ms2_intensity'):
+                self.__dict__.pop(name,None)
+            self._peaks = self.__dict__.pop('peaks')
+            return self._peaks
+
+    def set_peaks(self,peaks):
+        self._peaks = peaks
+        self.invalidate()
+
+    def invalidate(self):
+        # forget the derived fields, e.g. after changing the peaks in place
+        self._normalised_peaks = None
+        self._max_ms2_intensity = None
+        self._total_ms2_intensity = None
+
+    def _derived(self,name,function):
+        value = self.__dict__.get(name)
+        if value is None:
+            Spectrum.recompute_count += 1
+            value = function(self.peaks)
+            self.__dict__[name] = value
+        return value
+
+    def get_normalised_peaks(self):
+        return self._derived('_normalised_peaks',sqrt_normalise)
+
+    def get_max_ms2_intensity(self):
+        return self._derived('_max_ms2_intensity',max_intensity)
+
+    def get_total_ms2_intensity(self):
+        return self._derived('_total_ms2_intensity',total_intensity)
+
+    def get_n_peaks(self):
+        return len(self.peaks)
+
+    # The setters keep values worked out elsewhere (and let older pickles,
+    # which hold the fields as attributes, be restored). n_peaks always
+    # follows the peaks: jsonpickle restores the n_peaks of older pickles
+    # (with setattr, before the peaks) and only then is it dropped.
+    def set_normalised_peaks(self,normalised_peaks):
+        self._normalised_peaks = normalised_peaks
+
+    def set_max_ms2_intensity(self,max_ms2_intensity):
+        self._max_ms2_intensity = max_ms2_intensity
+
+    def set_total_ms2_intensity(self,total_ms2_intensity):
+        self._total_ms2_intensity = total_ms2_intensity
+
+    def set_n_peaks(self,n_peaks):
+        if '_peaks' in self.__dict__ or 'peaks' in self.__dict__:
+            raise AttributeError("n_peaks is the number of peaks, assign the peaks instead")
+
+    peaks = property(get_peaks,set_peaks)
+    normalised_peaks = property(get_normalised_peaks,set_normalised_peaks)
+    max_ms2_intensity = property(get_max_ms2_intensity,set_max_ms2_intensity)
+    total_ms2_intensity = property(get_total_ms2_intensity,set_total_ms2_intensity)
+    n_peaks = property(get_n_peaks,set_n_peaks)
+
     def get_annotation(self):
         if not 'annotation' in self.metadata:
             return None
@@ -78,19 +161,13 @@ class Spectrum(object):
 
 
     def normalise_max_intensity(self,max_intensity = 1000.0):
+        # spectra without intensity (all peaks 0) are left as they are
+        if not self.max_ms2_intensity > 0:
+            return
         new_peaks = []
         for mz,intensity in self.peaks:
             new_peaks.append((mz,max_intensity*(intensity/self.max_ms2_intensity)))
         self.peaks = new_peaks
-        self.n_peaks = len(self.peaks)
-        if self.n_peaks > 0:
-            self.normalised_peaks = sqrt_normalise(self.peaks)
-            self.max_ms2_intensity = max([intensity for mz,intensity in self.peaks])
-            self.total_ms2_intensity = sum([intensity for mz,intensity in self.peaks])
-        else:
-            self.normalised_peaks = []
-            self.max_ms2_intensity = 0.0
-            self.total_ms2_intensity = 0.0
 
 
     def randomise_intensities(self):
@@ -100,16 +177,8 @@ class Spectrum(object):
         new_peaks = []
         for i,(mz,intensity) in enumerate(self.peaks):
             new_peaks.append((mz,permuted_intensities[i]))
+        new_peaks.sort(key = lambda x: x[0])
         self.peaks = new_peaks
-        self.peaks.sort(key = lambda x: x[0])
-        if self.n_peaks > 0:
-            self.normalised_peaks = sqrt_normalise(self.peaks)
-            self.max_ms2_intensity = max([intensity for mz,intensity in self.peaks])
-            self.total_ms2_intensity = sum([intensity for mz,intensity in self.peaks])
-        else:
-            self.normalised_peaks = []
-            self.max_ms2_intensity = 0.0
-            self.total_ms2_intensity = 0.0        
 
     def flatten_peaks(self):
         max_intensity = max([p[1] for p in self.peaks])
@@ -117,39 +186,22 @@ class Spectrum(object):
         for mz,intensity in self.peaks:
             new_peaks.append((mz,max_intensity))
         self.peaks = new_peaks
-        if self.n_peaks > 0:
-            self.normalised_peaks = sqrt_normalise(self.peaks)
-            self.max_ms2_intensity = max([intensity for mz,intensity in self.peaks])
-            self.total_ms2_intensity = sum([intensity for mz,intensity in self.peaks])
-        else:
-            self.normalised_peaks = []
-            self.max_ms2_intensity = 0.0
-            self.total_ms2_intensity = 0.0
 
     def remove_top_perc(self,perc):
         # remove the peaks corresponding to the top perc of intensity
         total_intensity = sum([p[1] for p in self.peaks])
-        self.peaks.sort(key = lambda x: x[1])
+        by_intensity = sorted(self.peaks,key = lambda x: x[1])
         new_peaks = []
         total_found = 0.0
-        for mz,intensity in self.peaks:
+        for mz,intensity in by_intensity:
             total_found += intensity
             if total_found > (1-perc)*total_intensity:
                 break
             else:
                 new_peaks.append((mz,intensity))
 
+        new_peaks.sort(key = lambda x: x[0])
         self.peaks = new_peaks
-        self.peaks.sort(key = lambda x: x[0])
-
-        if self.n_peaks > 0:
-            self.normalised_peaks = sqrt_normalise(self.peaks)
-            self.max_ms2_intensity = max([intensity for mz,intensity in self.peaks])
-            self.total_ms2_intensity = sum([intensity for mz,intensity in self.peaks])
-        else:
-            self.normalised_peaks = []
-            self.max_ms2_intensity = 0.0
-            self.total_ms2_intensity = 0.0
 
     def remove_small_peaks(self,min_ms2_intensity = 10000):
         new_peaks = []
@@ -157,15 +209,6 @@ class Spectrum(object):
             if intensity >= min_ms2_intensity:
                 new_peaks.append((mz,intensity))
         self.peaks = new_peaks
-        self.n_peaks = len(self.peaks)
-        if self.n_peaks > 0:
-            self.normalised_peaks = sqrt_normalise(self.peaks)
-            self.max_ms2_intensity = max([intensity for mz,intensity in self.peaks])
-            self.total_ms2_intensity = sum([intensity for mz,intensity in self.peaks])
-        else:
-            self.normalised_peaks = []
-            self.max_ms2_intensity = 0.0
-            self.total_ms2_intensity = 0.0
 
 
     def remove_precursor_peak(self,tolerance = 17):
@@ -174,43 +217,13 @@ class Spectrum(object):
             if abs(mz - self.precursor_mz) > tolerance:
                 new_peaks.append((mz,intensity))
         self.peaks = new_peaks
-        self.n_peaks = len(self.peaks)
-        if self.n_peaks > 0:
-            self.normalised_peaks = sqrt_normalise(self.peaks)
-            self.max_ms2_intensity = max([intensity for mz,intensity in self.peaks])
-            self.total_ms2_intensity = sum([intensity for mz,intensity in self.peaks])
-        else:
-            self.normalised_peaks = []
-            self.max_ms2_intensity = 0.0
-            self.total_ms2_intensity = 0.0
         
 
     def keep_top_k(self,k=6,mz_range=50):
         # only keep peaks that are in the top k in += mz_range
-        start_pos = 0
-        new_peaks = []
-        for mz,intensity in self.peaks:
-            while self.peaks[start_pos][0]< mz-mz_range:
-                start_pos += 1
-            end_pos = start_pos
-            n_bigger = 0
-            while end_pos < len(self.peaks) and self.peaks[end_pos][0] <= mz+mz_range:
-                if self.peaks[end_pos][1] > intensity:
-                    n_bigger += 1
-                end_pos += 1
-            if n_bigger < k:
-                new_peaks.append((mz,intensity))
-
-        self.peaks = new_peaks
-        self.n_peaks = len(self.peaks)
-        if self.n_peaks > 0:
-            self.normalised_peaks = sqrt_normalise(self.peaks)
-            self.max_ms2_intensity = max([intensity for mz,intensity in self.peaks])
-            self.total_ms2_intensity = sum([intensity for mz,intensity in self.peaks])
-        else:
-            self.normalised_peaks = []
-            self.max_ms2_intensity = 0.0
-            self.total_ms2_intensity = 0.0
+        from molnet.preprocessing import top_k_in_window
+        keep = top_k_in_window([p[0] for p in self.peaks],[p[1] for p in self.peaks],k,mz_range)
+        self.peaks = [peak for peak,keep_peak in zip(self.peaks,keep.tolist()) if keep_peak]
         
 
     def print_spectrum(self):
@@ -237,6 +250,144 @@ class Spectrum(object):
         else:
             return 0
 
+# Array-backed alternative to Spectrum for large collections. The peaks are
+# held as numpy arrays (m/z always float64, intensities float64 or float32)
+# and there is no per-instance __dict__. The normalised intensities used for
+# scoring are computed once and cached. peaks and normalised_peaks are still
+# available as lists of (mz,intensity) tuples, built on demand.
+class CompactSpectrum(object):
+    __slots__ = ('mz','intensity','_normalised_intensity','file_name','scan_number',
+        'ms1','rt','precursor_mz','parent_mz','precursor_intensity','metadata',
+        'spectrum_id','spectrumid','name')
+
+    def __init__(self,peaks,file_name,scan_number,ms1,precursor_mz,parent_mz,rt = None,precursor_intensity = None,metadata = None,dtype = np.float64):
+        if isinstance(peaks,tuple) and len(peaks) == 2:
+            mz,intensity = peaks # already (mz array, intensity array)
+        else:
+            mz = [p[0] for p in peaks]
+            intensity = [p[1] for p in peaks]
+        mz = np.asarray(mz,dtype = np.float64)
+        intensity = np.asarray(intensity,dtype = dtype)
+        order = np.argsort(mz,kind = 'mergesort') # ensure sorted by mz
+        self._set_peaks(mz[order],intensity[order])
+        self.file_name = file_name
+        self.scan_number = scan_number
+        self.ms1 = ms1
+        self.rt = rt
+        self.precursor_mz = precursor_mz
+        self.parent_mz = parent_mz
+        self.precursor_intensity = precursor_intensity
+        self.metadata = metadata
+
+    def _set_peaks(self,mz,intensity):
+        self.mz = mz
+        self.intensity = intensity
+        self._normalised_intensity = None
+
+    def get_n_peaks(self):
+        return len(self.mz)
+
+    def get_peaks(self):
+        return list(zip(self.mz.tolist(),self.intensity.tolist()))
+
+    def get_normalised_peaks(self):
+        return list(zip(self.mz.tolist(),self.normalised_arrays()[1].tolist()))
+
+    def get_max_ms2_intensity(self):
+        if len(self.intensity) == 0:
+            return 0.0
+        return float(self.intensity.max())
+
+    def get_total_ms2_intensity(self):
+        if len(self.intensity) == 0:
+            return 0.0
+        # cumulative sum adds in order, giving the same total as Spectrum
+        return float(np.cumsum(self.intensity,dtype = np.float64)[-1])
+
+    n_peaks = property(get_n_peaks)
+    peaks = property(get_peaks)
+    normalised_peaks = property(get_normalised_peaks)
+    max_ms2_intensity = property(get_max_ms2_intensity)
+    total_ms2_intensity = property(get_total_ms2_intensity)
+
+    def normalised_arrays(self):
+        # the sqrt normalised peaks as (mz,intensity) float64 arrays
+        if self._normalised_intensity is None:
+            intensity = self.intensity.astype(np.float64)
+            if len(intensity) > 0:
+                norm_facc = math.sqrt(np.cumsum(intensity)[-1])
+                self._normalised_intensity = np.sqrt(intensity)/norm_facc
+            else:
+                self._normalised_intensity = intensity
+        return self.mz,self._normalised_intensity
+
+    def get_annotation(self):
+        if not self.metadata or not 'annotation' in self.metadata:
+            return None
+        else:
+            anns = self.metadata['annotation']
+            anns.sort(key = lambda x: x.score,reverse = True)
+            return anns[0]
+
+    annotation = property(get_annotation)
+
+    def normalise_max_intensity(self,max_intensity = 1000.0):
+        if len(self.intensity) > 0 and self.intensity.max() > 0:
+            self._set_peaks(self.mz,max_intensity*(self.intensity/self.intensity.max()))
+
+    def remove_small_peaks(self,min_ms2_intensity = 10000):
+        keep = self.intensity >= min_ms2_intensity
+        self._set_peaks(self.mz[keep],self.intensity[keep])
+
+    def remove_precursor_peak(self,tolerance = 17):
+        keep = np.abs(self.mz - self.precursor_mz) > tolerance
+        self._set_peaks(self.mz[keep],self.intensity[keep])
+
+    def keep_top_k(self,k=6,mz_range=50):
+        # only keep peaks that are in the top k in += mz_range
+        from molnet.preprocessing import top_k_in_window
+        keep = top_k_in_window(self.mz,self.intensity,k,mz_range)
+        self._set_peaks(self.mz[keep],self.intensity[keep])
+
+    def to_spectrum(self):
+        # convert back to a (list based) Spectrum
+        return Spectrum(self.peaks,self.file_name,self.scan_number,self.ms1,
+            self.precursor_mz,self.parent_mz,rt = self.rt,
+            precursor_intensity = self.precursor_intensity,metadata = self.metadata)
+
+    def print_spectrum(self):
+        print()
+        print(self.file_name,self.scan_number)
+        normalised_intensity = self.normalised_arrays()[1]
+        for i,(mz,intensity) in enumerate(self.peaks):
+            print(i,mz,intensity,normalised_intensity[i])
+
+    def plot(self,xlim = None,**kwargs):
+        plot_spectrum(self.peaks,xlim=xlim,title = "{} {} (m/z= {})".format(self.file_name,self.scan_number,self.parent_mz),**kwargs)
+
+    def __str__(self):
+        return "Spectrum from scan {} in {} with {} peaks, max_ms2_intensity {}".format(self.scan_number,self.file_name,self.n_peaks,self.max_ms2_intensity)
+
+    def __lt__(self,other):
+        if self.parent_mz <= other.parent_mz:
+            return 1
+        else:
+            return 0
+
+
+def compact_spectrum(spectrum,dtype = np.float64):
+    # make a CompactSpectrum from a Spectrum, keeping the identifiers that
+    # the library loaders attach to their spectra
+    mz = np.array([p[0] for p in spectrum.peaks],dtype = np.float64)
+    intensity = np.array([p[1] for p in spectrum.peaks],dtype = dtype)
+    compact = CompactSpectrum((mz,intensity),spectrum.file_name,spectrum.scan_number,
+        spectrum.ms1,spectrum.precursor_mz,spectrum.parent_mz,rt = spectrum.rt,
+        precursor_intensity = spectrum.precursor_intensity,metadata = spectrum.metadata)
+    for attr in ('spectrum_id','spectrumid','name'):
+        if hasattr(spectrum,attr):
+            setattr(compact,attr,getattr(spectrum,attr))
+    return compact
+
 # Class to hold a cluster of spectra
 class Cluster(object):
     def __init__(self,spectrum,cluster_id):
@@ -245,39 +396,67 @@ class Cluster(object):
         self.set_prototype()
         self.cluster_id = cluster_id
 
+    # the peaks are those of the prototype (the first spectrum), read from
+    # it when needed. Older pickles hold copies of them, which jsonpickle
+    # restores (with setattr, before the prototype); only then are they
+    # dropped.
+    def get_peaks(self):
+        return self.spectrum.peaks
+
+    def get_normalised_peaks(self):
+        return self.spectrum.normalised_peaks
+
+    def get_n_peaks(self):
+        return self.spectrum.n_peaks
+
+    def set_copied_field(self,value):
+        if 'spectrum' in self.__dict__:
+            raise AttributeError("the peaks of a cluster are those of its prototype, set them on cluster.spectrum")
+
+    peaks = property(get_peaks,set_copied_field)
+    normalised_peaks = property(get_normalised_peaks,set_copied_field)
+    n_peaks = property(get_n_peaks,set_copied_field)
+
     def get_annotation(self):
         return self.spectrum.annotation 
     
     annotation = property(get_annotation)
 
     def get_mgf_string(self):
-        out_string = ""
-        out_string += "BEGIN IONS\n"
-        out_string += "FEATURE_ID={}\n".format(self.cluster_id)
-        out_string += "PEPMASS={}\n".format(self.spectrum.precursor_mz)
-        out_string += "SCANS={}\n".format(self.cluster_id)
-        out_string += "RTINSECONDS={}\n".format(self.spectrum.rt)
-        out_string += "CHARGE={}\n".format(self.spectrum.ms1.charge)
-        out_string += "MSLEVEL=2\n"
-        out_string += "FILENAME={}\n".format(self.spectrum.file_name)
-        for p in self.spectrum.peaks:
-            out_string += "{} {}\n".format(p[0],p[1])
-        out_string += "END IONS\n\n"
-        return out_string
+        from molnet.mgf import format_spectrum
+        return format_spectrum([('FEATURE_ID',self.cluster_id),
+                                ('PEPMASS',self.spectrum.precursor_mz),
+                                ('SCANS',self.cluster_id),
+                                ('RTINSECONDS',self.spectrum.rt),
+                                ('CHARGE',self.spectrum.ms1.charge),
+                                ('MSLEVEL',2),
+                                ('FILENAME',self.spectrum.file_name)],self.spectrum.peaks)
 
 
     def get_file_intensity_dict(self):
-        file_intensity = {}
-        for spectrum in self.spectra:
-            if spectrum.precursor_intensity:
-                this_file = spectrum.file_name
-                this_intensity = spectrum.precursor_intensity
-                if not this_file in file_intensity:
-                    file_intensity[this_file] = this_intensity
-                else:
-                    ma = max(this_intensity,file_intensity[this_file])
-                    file_intensity[this_file] = ma
-        return file_intensity
+        # the highest precursor intensity of the spectra from each file
+        return dict(self.file_stats()[1])
+
+    def file_stats(self):
+        # Per file counts of the member spectra and their highest precursor
+        # intensity, kept up to date by add_spectrum (and rebuilt here for
+        # clusters unpickled from before they were kept)
+        if getattr(self,'_file_counts',None) is None:
+            self._file_counts = {}
+            self._file_intensity = {}
+            for spectrum in self.spectra:
+                self._count_spectrum(spectrum)
+        return self._file_counts,self._file_intensity
+
+    def _count_spectrum(self,spectrum):
+        this_file = spectrum.file_name
+        self._file_counts[this_file] = self._file_counts.get(this_file,0) + 1
+        if spectrum.precursor_intensity:
+            this_intensity = spectrum.precursor_intensity
+            if not this_file in self._file_intensity:
+                self._file_intensity[this_file] = this_intensity
+            else:
+                self._file_intensity[this_file] = max(this_intensity,self._file_intensity[this_file])
     def member_string(self):
         ms = ":".join(["{}_{}".format(s.file_name,s.scan_number) for s in self.spectra])
         return ms
@@ -319,39 +498,48 @@ class Cluster(object):
         # This allows us to treat the Cluster as a spectrum and compute
         # similarities etc
         self.spectra.sort(key = lambda x: x.total_ms2_intensity,reverse = True)
-        self.peaks = self.spectra[0].peaks # always keep the prototype at the start
-        self.normalised_peaks = self.spectra[0].normalised_peaks
-        self.n_peaks = self.spectra[0].n_peaks
+        # the spectra may have been changed directly: recount
+        self._totals = [-s.total_ms2_intensity for s in self.spectra]
+        self._file_counts = None
+        self.file_stats()
+        self.set_prototype_fields()
+
+    def set_prototype_fields(self):
+        # copy the prototype (the first spectrum) fields to the cluster
         self.spectrum = self.spectra[0]
         self.precursor_mz = self.spectra[0].precursor_mz
         self.parent_mz = self.spectra[0].parent_mz
 
 
     def add_spectrum(self,spectrum):
-        self.spectra.append(spectrum)
+        # insert the spectrum where set_prototype's (stable) sort by
+        # total_ms2_intensity would put it, after any equal ones
+        if getattr(self,'_totals',None) is None:
+            self._totals = [-s.total_ms2_intensity for s in self.spectra]
+        self.file_stats()
+        pos = bisect.bisect_right(self._totals,-spectrum.total_ms2_intensity)
+        self._totals.insert(pos,-spectrum.total_ms2_intensity)
+        self.spectra.insert(pos,spectrum)
         self.n_spectra += 1
-        self.set_prototype()
+        self._count_spectrum(spectrum)
+        if pos == 0:
+            self.set_prototype_fields()
 
     def n_unique_files(self):
-        files = [s.file_name for s in self.spectra]
-        return len(set(files))
+        return len(self.file_stats()[0])
 
     def contains_file(self,list_of_files):
-        my_files = set([s.file_name for s in self.spectra])
-        if len(my_files.intersection(set(list_of_files))) > 0:
-            return True
+        file_counts = self.file_stats()[0]
+        for file_name in list_of_files:
+            if file_name in file_counts:
+                return True
         return False
 
     def n_members_in_file(self,list_of_files):
         # returns a list of length(list_of_files) with the 
         # number of spectra it has from each of the files
-        file_pos = {}
-        for pos,file_name in enumerate(list_of_files):
-            file_pos[file_name] = pos
-        counts = [0 for file_name in list_of_files]
-        for spec in self.spectra:
-            counts[file_pos[spec.file_name]] += 1
-        return counts
+        file_counts = self.file_stats()[0]
+        return [file_counts.get(file_name,0) for file_name in list_of_files]
 
     
     def n_metadata_in_cluster(self,list_of_metadata_items,filename_to_metadata):
@@ -359,10 +547,10 @@ class Cluster(object):
         for pos,metadata_item in enumerate(list_of_metadata_items):
             metadata_pos[metadata_item] = pos
         counts = [0 for i in list_of_metadata_items]
-        for spec in self.spectra:
-            if spec.file_name in filename_to_metadata:
-                this_metadata = filename_to_metadata[spec.file_name]
-                counts[metadata_pos[this_metadata]] += 1
+        for file_name,count in self.file_stats()[0].items():
+            if file_name in filename_to_metadata:
+                this_metadata = filename_to_metadata[file_name]
+                counts[metadata_pos[this_metadata]] += count
         n_non_zero = 0
         for c in counts:
             if c > 0:
@@ -382,14 +570,29 @@ class Cluster(object):
         else:
             return -1
 
+    def __lt__(self,other):
+        # for sorting cluster lists under python 3 (no __cmp__)
+        return self.parent_mz < other.parent_mz
+
 class MolecularFamily(object):
     # A class to hold a molecular family object
     def __init__(self,graph_object,family_id):
-        self.clusters = list(graph_object.edge_dict.keys())
+        self.clusters = graph_object.node_index()[0]
         self.n_clusters = len(self.clusters)
         self.scores = self.convert_graph_to_scores(graph_object)
         self.family_id = family_id
 
+    @classmethod
+    def from_scores(cls,clusters,scores,family_id):
+        # a family from its clusters and (cluster,cluster,score) edges,
+        # without a graph (see network_io.load_network)
+        family = cls.__new__(cls)
+        family.clusters = clusters
+        family.n_clusters = len(clusters)
+        family.scores = scores
+        family.family_id = family_id
+        return family
+
     def report(self,similarity_function,similarity_tolerance,**kwargs):
         print
         print("Molecular family object containing {} clusters".format(len(self.clusters)))
@@ -401,14 +604,7 @@ class MolecularFamily(object):
                 print("Not plotting as too many clusters, use plot_spectral_alignment to plot individual pairs")
 
     def convert_graph_to_scores(self,graph_object):
-        done = set()
-        scores = []
-        for node,edges in graph_object.edge_dict.items():
-            for node2,weight in edges:
-                if not (node,node2) in done:
-                    scores.append((node,node2,weight))
-                    done.add((node2,node))
-        return scores
+        return graph_object.edge_list()
     def n_members_in_file(self,list_of_files):
         counts = [0 for i in list_of_files]
         for cluster in self.clusters:
@@ -431,79 +627,19 @@ class MolecularFamily(object):
         for cluster in self.clusters:
             cluster.plot_spectrum(xlim = xlim,**kwargs)
 
-def write_mnet_files(molecular_families,file_name,parameters,metadata = None,pickle = True,write_mgf = True,extra_node_data = None):
+def write_mnet_files(molecular_families,file_name,parameters,metadata = None,pickle = True,write_mgf = True,extra_node_data = None,binary = True,table_format = 'csv',concurrent = False):
     import csv,jsonpickle
-    # write a csv file from a list of molecular molecular_families
-    csv_name = file_name + '_nodes.csv'
-    edge_file = file_name + '_edges.csv'
-    mgf_file = file_name + '.mgf'
-    # First need to find all the unique files
-    unique_files = []
-    for family in molecular_families:
-        for cluster in family.clusters:
-            for spectrum in cluster.spectra:
-                unique_files.append(spectrum.file_name)
-    unique_files = sorted(list(set(unique_files)))
-    heads = ['cid','familyid','precursor_mz','parent_mz','short_precursor_mz','short_parent_mz','charge','members','n_unique_files'] + unique_files
-    if metadata:
-        for mlist,mdict,mtitle in metadata:
-            heads += mlist + [mtitle]
-    if extra_node_data:
-        for extra in extra_node_data:
-            heads += extra[0]
-    print("Writing csv")
-    with open(csv_name,'w') as f:
-        writer = csv.writer(f)
-        writer.writerow(heads)
-        for family in molecular_families:
-            for cluster in family.clusters:
-                newrow = [cluster.cluster_id,family.family_id,cluster.precursor_mz,cluster.parent_mz]
-                newrow += ["{:.2f}".format(cluster.precursor_mz),"{:.2f}".format(cluster.parent_mz)]
-                newrow += [cluster.spectrum.ms1.charge]
-                newrow += [cluster.member_string()]
-                newrow += [cluster.n_unique_files()]
-                newrow += cluster.n_members_in_file(unique_files)
-                if metadata:
-                    for mlist,mdict,mtitle in metadata:
-                        counts,nnz = cluster.n_metadata_in_cluster(mlist,mdict)
-                        newrow += counts + [nnz]
-                if extra_node_data:
-                    for extra in extra_node_data:
-                        newrow += extra[1][cluster.cluster_id]
-                writer.writerow(newrow)
-    print("Writing edges")
-    with open(edge_file,'w') as f:
-        writer = csv.writer(f)
-        writer.writerow(["source","target","weight"])
-        for family in molecular_families:
-            scores = family.scores
-            if len(scores) > 0:
-                for node1,node2,weight in scores:
-                    writer.writerow([node1.cluster_id,node2.cluster_id,weight])
-            else:
-                # Singleteon family -- write the self loop
-                assert len(family.clusters) == 1
-                cluster = family.clusters[0]
-                writer.writerow([cluster.cluster_id,cluster.cluster_id,'self'])
-
-    # finally, write the mgf-style file
-    if write_mgf:
-        print("Writing mgf")
-        with open(mgf_file,'w') as f:
-            for family in molecular_families:
-                for cluster in family.clusters:
-                    f.write("BEGIN IONS\n")
-                    f.write("FILENAME={}\n".format(cluster.spectrum.file_name))
-                    f.write("SCANNO={}\n".format(cluster.spectrum.scan_number))
-                    f.write("CID={}\n".format(cluster.cluster_id))
-                    f.write("FAMILYID={}\n".format(family.family_id))
-                    f.write("PEPMASS={}\n".format(cluster.spectrum.precursor_mz))
-                    f.write("RTINSECONDS={}\n".format(cluster.spectrum.rt))
-                    f.write("CHARGE={}\n".format(cluster.spectrum.ms1.charge))
-                    f.write("NAME={}\n".format(cluster.cluster_id))
-                    for mz,intensity in cluster.spectrum.peaks:
-                        f.write("{} {}\n".format(mz,intensity))
-                    f.write("END IONS\n\n")
+    # write the node and edge tables and the mgf-style file (see
+    # molnet.export), then the binary network, the pickles and the parameters
+    from molnet.export import export_network
+    export_network(molecular_families,file_name,metadata = metadata,write_mgf = write_mgf,
+        extra_node_data = extra_node_data,table_format = table_format,concurrent = concurrent)
+
+    if binary:
+        # much smaller and faster to reload than the pickle (see molnet.network_io)
+        from molnet.network_io import save_network
+        print("Writing binary network")
+        save_network(molecular_families,file_name + '_network.npz',parameters)
 
     if pickle:
         print("Writing pickle")
@@ -523,14 +659,85 @@ def write_mnet_files(molecular_families,file_name,parameters,metadata = None,pic
 
 
 
+class ClusterIndex(object):
+    # Clusters sorted by the parent m/z of their prototypes, for merge and
+    # cluster_spectra: finding the clusters within ms1_tolerance of a
+    # spectrum is a bisection plus the window, instead of a scan of the
+    # whole list. Clusters with equal parent m/z stay in the order they were
+    # added. If a cluster's prototype (and so its parent m/z) changes, call
+    # update() so it is re-keyed.
+    def __init__(self,clusters = []):
+        from sortedcontainers import SortedList
+        self.keys = SortedList()
+        self.key_of = {} # id(cluster) -> key
+        self.clusters = {} # key -> cluster
+        self.n_added = 0
+        for cluster in clusters:
+            self.add(cluster)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        # the clusters in parent m/z order
+        for key in self.keys:
+            yield self.clusters[key]
+
+    def add(self,cluster):
+        key = (cluster.parent_mz,self.n_added)
+        self.n_added += 1
+        self.keys.add(key)
+        self.key_of[id(cluster)] = key
+        self.clusters[key] = cluster
+
+    def update(self,cluster):
+        # re-key a cluster whose prototype has changed
+        key = self.key_of[id(cluster)]
+        if key[0] != cluster.parent_mz:
+            self.keys.remove(key)
+            del self.clusters[key]
+            key = (cluster.parent_mz,key[1])
+            self.keys.add(key)
+            self.key_of[id(cluster)] = key
+            self.clusters[key] = cluster
+
+    def candidates(self,parent_mz,ms1_tolerance,rt = None,rt_tolerance = None):
+        # the clusters with abs(parent_mz - prototype parent_mz) <=
+        # ms1_tolerance (and prototype rt within rt_tolerance, if given) in
+        # parent m/z order
+        slack = ms1_tolerance*1e-9 + 1e-9 # the exact test is below
+        found = []
+        for key in self.keys.irange((parent_mz - ms1_tolerance - slack,-1),(parent_mz + ms1_tolerance + slack,self.n_added)):
+            cluster = self.clusters[key]
+            if abs(parent_mz - cluster.spectrum.parent_mz) <= ms1_tolerance:
+                if rt_tolerance is None or abs(cluster.spectrum.rt - rt) < rt_tolerance:
+                    found.append(cluster)
+        return found
+
+
 def merge(cluster_list,spectrum,similarity_function,similarity_tolerance,min_match,score_threshold = 0.95,rt_tolerance = 1000000,ms1_tolerance=0.02,initial_cluster_id = 0):
     # Compute the siilarity between the spectrum and all clusters in the list
     # if a cluster is found with score >= threshold
     # add the spectrum to the cluster and return
     # If none is found, create a new singleton cluster and append to the list
+    #
+    # cluster_list can be a ClusterIndex, which finds the candidate clusters
+    # without scanning them all (see cluster_spectra)
 
     next_id = initial_cluster_id
 
+    score_function = get_score_function(similarity_function)
+    if isinstance(cluster_list,ClusterIndex):
+        for cluster in cluster_list.candidates(spectrum.parent_mz,ms1_tolerance):
+            if abs(cluster.spectrum.rt - spectrum.rt) < rt_tolerance:
+                score = score_function(cluster,spectrum,similarity_tolerance,min_match)
+                if score >= score_threshold:
+                    cluster.add_spectrum(spectrum)
+                    cluster_list.update(cluster)
+                    return next_id
+        cluster_list.add(Cluster(spectrum,next_id))
+        next_id += 1
+        return next_id
 
     # Slow version
     possible_idx = []
@@ -538,61 +745,453 @@ def merge(cluster_list,spectrum,similarity_function,similarity_tolerance,min_mat
         if abs(spectrum.parent_mz - cluster.spectrum.parent_mz) <= ms1_tolerance:
             possible_idx.append(i)
 
-    # fast version
-    # spectrum.precursor_mz -= ms1_tolerance
-    # min_pos = bisect.bisect_left(cluster_list,spectrum)
-    # spectrum.precursor_mz += ms1_tolerance
-    # spectrum.precursor_mz += ms1_tolerance
-    # max_pos = bisect.bisect_right(cluster_list,spectrum)
-    # spectrum.precursor_mz -= ms1_tolerance
-    # possible_idx = range(min_pos,max_pos)
-    
     for idx in possible_idx:
         cluster = cluster_list[idx]
         if abs(cluster.spectrum.rt - spectrum.rt) < rt_tolerance: 
-            score,match_list = similarity_function(cluster,spectrum,similarity_tolerance,min_match)
+            score = score_function(cluster,spectrum,similarity_tolerance,min_match)
             if score >= score_threshold:
                 cluster.add_spectrum(spectrum)
                 # re-sort
-                # cluster_list.sort()
                 cluster_list[possible_idx[0]:possible_idx[-1]+1] = sorted(cluster_list[possible_idx[0]:possible_idx[-1]+1])
-                # for i,c in enumerate(cluster_list[:-1]):
-                #     if not cluster_list[i+1] >= cluster_list[i]:
-                #         print possible_idx,i
                 return next_id
     # if we get to here, nothing was found
-    # insertion_point = bisect.bisect_left(cluster_mz_list,spectrum.precursor_mz)
     bisect.insort(cluster_list,Cluster(spectrum,next_id))
-    # cluster_list.append(Cluster(spectrum,next_id))
-    # cluster_list.sort(key = lambda x: x.spectrum.precursor_mz)
     next_id += 1
     return next_id
 
-   
-def make_initial_network(cluster_list,similarity_function,similarity_tolerance,min_match,score_threshold,k=10,mc=1,max_shift = 100):
 
-    # Do the MC filtering
-    filtered_cluster_list = list(filter(lambda x: len(x.spectra)>=mc,cluster_list))
-
-
-    edges = []
-    edge_dict = {}
+def cluster_spectra(spectra,similarity_function,similarity_tolerance,min_match,score_threshold = 0.95,rt_tolerance = 1000000,ms1_tolerance = 0.02,initial_cluster_id = 0,n_jobs = 1,bands_per_job = 4):
+    # Greedy clustering of a list of spectra, in order, as repeated calls
+    # to merge would do it. Returns the clusters sorted by parent m/z.
+    #
+    # With n_jobs > 1 the spectra are split into parent m/z bands, cut only
+    # where consecutive parent m/z values are more than ms1_tolerance apart,
+    # and the bands are clustered in a pool of n_jobs processes. No cluster
+    # can take spectra from two such bands, so the clusters and their ids
+    # are the same as in a sequential run.
+    if n_jobs > 1:
+        return parallel_cluster_spectra(spectra,similarity_function,similarity_tolerance,min_match,score_threshold = score_threshold,
+            rt_tolerance = rt_tolerance,ms1_tolerance = ms1_tolerance,initial_cluster_id = initial_cluster_id,n_jobs = n_jobs,bands_per_job = bands_per_job)
+    cluster_index = ClusterIndex()
+    next_id = initial_cluster_id
+    for i,spectrum in enumerate(spectra):
+        if i%1000 == 0 and i > 0:
+            print("Clustered {} of {} spectra into {} clusters".format(i,len(spectra),len(cluster_index)))
+        next_id = merge(cluster_index,spectrum,similarity_function,similarity_tolerance,min_match,
+            score_threshold = score_threshold,rt_tolerance = rt_tolerance,ms1_tolerance = ms1_tolerance,initial_cluster_id = next_id)
+    return list(cluster_index)
+
+
+def precursor_bands(sorted_parent_mz,ms1_tolerance,n_bands):
+    # Split sorted parent m/z values into at most n_bands contiguous
+    # (start,end) bands of similar size, cutting only between neighbours
+    # more than ms1_tolerance apart
+    n = len(sorted_parent_mz)
+    cuts = np.flatnonzero(np.diff(sorted_parent_mz) > ms1_tolerance) + 1
+    boundaries = [0]
+    for b in range(1,n_bands):
+        pos = int(np.searchsorted(cuts,n*b/float(n_bands),side = 'left'))
+        if pos < len(cuts) and cuts[pos] > boundaries[-1]:
+            boundaries.append(int(cuts[pos]))
+    boundaries.append(n)
+    return list(zip(boundaries[:-1],boundaries[1:]))
+
+
+def _cluster_band(task):
+    # cluster one band of spectra (given with their positions in the input),
+    # returning the positions of each cluster's members in the order they
+    # joined it
+    positions,spectra,parameters = task
+    position_of = dict([(id(s),p) for p,s in zip(positions,spectra)])
+    clusters = cluster_spectra(spectra,*parameters)
+    return [sorted([position_of[id(s)] for s in c.spectra]) for c in clusters]
+
+
+def parallel_cluster_spectra(spectra,similarity_function,similarity_tolerance,min_match,score_threshold = 0.95,rt_tolerance = 1000000,ms1_tolerance = 0.02,initial_cluster_id = 0,n_jobs = 2,bands_per_job = 4):
+    # cluster_spectra over parent m/z bands in a pool of n_jobs processes.
+    # The workers return cluster memberships, from which the clusters are
+    # rebuilt here (from the caller's spectra, members added in input order
+    # as merge adds them). Cluster ids follow the input position of the
+    # first spectrum of each cluster, which is the order a sequential run
+    # creates them in.
+    from concurrent.futures import ProcessPoolExecutor
+    parent_mz = np.array([s.parent_mz for s in spectra],dtype = np.float64)
+    order = np.argsort(parent_mz,kind = 'mergesort')
+    bands = precursor_bands(parent_mz[order],ms1_tolerance,n_jobs*bands_per_job)
+    parameters = (similarity_function,similarity_tolerance,min_match,score_threshold,rt_tolerance,ms1_tolerance)
+    tasks = []
+    for start,end in bands:
+        positions = np.sort(order[start:end]).tolist()
+        tasks.append((positions,[spectra[p] for p in positions],parameters))
+    print("Clustering {} spectra in {} bands".format(len(spectra),len(bands)))
+    memberships = []
+    with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+        for band_memberships in executor.map(_cluster_band,tasks):
+            memberships += band_memberships
+    # ids in the order of the first members
+    first = sorted(range(len(memberships)),key = lambda c: memberships[c][0])
+    cluster_id = [0]*len(memberships)
+    for rank,c in enumerate(first):
+        cluster_id[c] = initial_cluster_id + rank
+    clusters = []
+    for c,members in enumerate(memberships):
+        cluster = Cluster(spectra[members[0]],cluster_id[c])
+        for p in members[1:]:
+            cluster.add_spectrum(spectra[p])
+        clusters.append(cluster)
+    return clusters
+
+
+def make_initial_network(cluster_list,similarity_function,similarity_tolerance,min_match,score_threshold,k=10,mc=1,max_shift = 100,n_jobs = 1,stats = None,use_index = True,score_cache = None,compact_graph = False):
+    # Score all pairs within max_shift (see score_pairs for the options) and
+    # build the top-k filtered network of the pairs reaching score_threshold
+    filtered_cluster_list,edges = score_pairs(cluster_list,similarity_function,similarity_tolerance,min_match,score_threshold,
+        mc = mc,max_shift = max_shift,n_jobs = n_jobs,stats = stats,use_index = use_index,score_cache = score_cache)
+    return build_network(filtered_cluster_list,edges,k = k,compact_graph = compact_graph)
+
+
+def build_network(cluster_list,edges,k = 10,compact_graph = False):
+    # the top-k filtered Graph of the clusters with edges (i,j,score),
+    # where i and j are positions in cluster_list (a CSRGraph if
+    # compact_graph)
+    if compact_graph:
+        edges = list(edges)
+        G = CSRGraph.from_edges(cluster_list,[e[0] for e in edges],[e[1] for e in edges],[e[2] for e in edges])
+        return G.topk_filter(k = k)
     G = Graph()
-    for cluster in filtered_cluster_list:
+    for cluster in cluster_list:
         G.add_node(cluster)
-    for i,cluster in enumerate(filtered_cluster_list[:-1]):
-        if i%200 == 0 and i > 0:
-            print("Done {} of {}".format(i,len(filtered_cluster_list)))
-        for cluster2 in filtered_cluster_list[i+1:]:
-            if abs(cluster.parent_mz - cluster2.parent_mz) < max_shift:
-                score,_ = similarity_function(cluster,cluster2,similarity_tolerance,min_match)
-                if score >= score_threshold:
-                    G.add_edge(cluster,cluster2,score)
+    for i,j,score in edges:
+        G.add_edge(cluster_list[i],cluster_list[j],score)
 
     filtered_graph = G.topk_filter(k = k)
 
     return filtered_graph
 
+
+def score_pairs(cluster_list,similarity_function,similarity_tolerance,min_match,score_threshold,mc=1,max_shift = 100,n_jobs = 1,stats = None,use_index = True,score_cache = None):
+    # Returns the clusters with at least mc spectra and a list of (i,j,score)
+    # for the pairs of them (positions in that list, i < j) that score at
+    # least score_threshold, ordered by (i,j).
+    #
+    # If stats is a dict it is filled with the number of pairs within
+    # max_shift that were actually scored ('n_pairs_scored') out of all
+    # possible pairs ('n_pairs_total'). With the standard scoring functions
+    # it also gets the number of those pairs that were pruned without
+    # running the full matching, by rule (see score_block).
+    #
+    # With use_index (and a standard scoring function and a positive
+    # threshold) the pairs in the window are further restricted to those
+    # sharing at least min_match fragment or neutral loss bins (see
+    # FragmentIndex); the others can't score and are counted as
+    # 'n_pruned_index'.
+    #
+    # If score_cache (a ScoreCache) is given, scores of pairs of identical
+    # spectra from earlier runs are read from it instead of being computed,
+    # and new exact scores are added to it (standard scoring functions only).
+
+    # Do the MC filtering
+    filtered_cluster_list = list(filter(lambda x: len(x.spectra)>=mc,cluster_list))
+
+    # Only pairs with parent m/z closer than max_shift are scored: sort by
+    # parent m/z and sweep a window along the sorted list
+    parent_mz = np.array([c.parent_mz for c in filtered_cluster_list],dtype = np.float64)
+    order = np.argsort(parent_mz,kind = 'mergesort')
+    window_end = precursor_windows(parent_mz[order],max_shift)
+    n_clusters = len(filtered_cluster_list)
+    n_pairs_scored = int((window_end - np.arange(n_clusters) - 1).sum()) if n_clusters > 0 else 0
+    n_pairs_total = n_clusters*(n_clusters-1)//2
+    print("Scoring {} of {} pairs".format(n_pairs_scored,n_pairs_total))
+    if stats is None:
+        stats = {}
+    stats['n_pairs_scored'] = n_pairs_scored
+    stats['n_pairs_total'] = n_pairs_total
+
+    # the standard scoring functions can score a whole row at once
+    batch_function = BATCH_FUNCTIONS.get(similarity_function,None)
+    if n_jobs > 1 and not batch_function:
+        print("Parallel scoring needs fast_cosine or fast_cosine_shift, scoring on one core")
+    if batch_function:
+        packed = pack_spectra([filtered_cluster_list[i] for i in order])
+        shift = BATCH_SHIFT[batch_function]
+        index = None
+        if use_index and score_threshold > 0:
+            index = FragmentIndex(packed,similarity_tolerance,use_losses = shift)
+        cache_lookup = None
+        cache_updates = None
+        if score_cache is not None:
+            cache_lookup = (score_cache,sc.parameter_key(similarity_function,similarity_tolerance,min_match),sc.spectrum_keys(packed))
+            cache_updates = {'new': [],'used': []}
+        if n_jobs > 1:
+            edges = parallel_score_rows(packed,order,window_end,similarity_tolerance,min_match,score_threshold,shift,n_jobs,stats = stats,index = index,
+                cache_lookup = cache_lookup,cache_updates = cache_updates)
+        else:
+            edges = score_rows(packed,order,window_end,0,n_clusters,similarity_tolerance,min_match,score_threshold,shift,verbose = True,stats = stats,index = index,
+                cache_lookup = cache_lookup,cache_updates = cache_updates)
+        n_pruned = sum([stats.get(key,0) for key in ('n_pruned_index','n_pruned_peaks','n_pruned_matches','n_pruned_bound')])
+        print("Pruned {} of {} pairs without full scoring".format(n_pruned,n_pairs_scored))
+        if score_cache is not None:
+            print("{} scores from the cache, {} new".format(len(cache_updates['used']),len(cache_updates['new'])))
+            stats['n_cache_hits'] = len(cache_updates['used'])
+            score_cache.store(cache_lookup[1],cache_updates['new'],used = cache_updates['used'])
+    else:
+        score_function = get_score_function(similarity_function)
+        edges = []
+        for a in range(n_clusters):
+            if a%200 == 0 and a > 0:
+                print("Done {} of {}".format(a,n_clusters))
+            for b in range(a+1,window_end[a]):
+                i,j = sorted((order[a],order[b]))
+                score = score_function(filtered_cluster_list[i],filtered_cluster_list[j],similarity_tolerance,min_match)
+                if score >= score_threshold:
+                    edges.append((i,j,score))
+
+    # order the edges as a full double loop over the unsorted list would
+    edges.sort(key = lambda x: (x[0],x[1]))
+    return filtered_cluster_list,edges
+
+
+# Sparse matrix of pairwise scores (upper triangle, COO triplets) for a list
+# of clusters, kept so the network can be rebuilt for any stricter
+# score_threshold, k or beta without rescoring (see network_from_score_matrix)
+class ScoreMatrix(object):
+    def __init__(self,cluster_ids,rows,cols,scores,parameters):
+        self.cluster_ids = cluster_ids # cluster_id of each row/column
+        self.rows = rows
+        self.cols = cols
+        self.scores = scores
+        self.parameters = parameters # scoring parameters, incl. the score_floor
+
+    def __len__(self):
+        return len(self.scores)
+
+    def to_csr(self):
+        # as a symmetric scipy.sparse CSR matrix (needs scipy)
+        from scipy.sparse import csr_matrix
+        n = len(self.cluster_ids)
+        return csr_matrix((np.concatenate((self.scores,self.scores)),
+            (np.concatenate((self.rows,self.cols)),np.concatenate((self.cols,self.rows)))),shape = (n,n))
+
+    def save(self,file_name):
+        import json
+        meta = json.dumps({'cluster_ids': list(self.cluster_ids),'parameters': self.parameters})
+        np.savez(file_name,rows = self.rows,cols = self.cols,scores = self.scores,meta = np.array(meta))
+
+
+def load_score_matrix(file_name):
+    import json
+    with np.load(file_name) as data:
+        meta = json.loads(str(data['meta']))
+        return ScoreMatrix(meta['cluster_ids'],data['rows'],data['cols'],data['scores'],meta['parameters'])
+
+
+def score_matrix(cluster_list,similarity_function,similarity_tolerance,min_match,score_floor = 0.2,mc = 1,max_shift = 100,n_jobs = 1,stats = None,score_cache = None):
+    # Score the pairs of clusters (as make_initial_network) and keep every
+    # score of at least score_floor as a ScoreMatrix
+    filtered_cluster_list,edges = score_pairs(cluster_list,similarity_function,similarity_tolerance,min_match,score_floor,
+        mc = mc,max_shift = max_shift,n_jobs = n_jobs,stats = stats,score_cache = score_cache)
+    rows = np.array([e[0] for e in edges],dtype = np.int64)
+    cols = np.array([e[1] for e in edges],dtype = np.int64)
+    scores = np.array([e[2] for e in edges],dtype = np.float64)
+    parameters = {'similarity_function': similarity_function.__name__,
+        'similarity_tolerance': similarity_tolerance,'min_match': min_match,
+        'score_floor': score_floor,'mc': mc,'max_shift': max_shift}
+    return ScoreMatrix([c.cluster_id for c in filtered_cluster_list],rows,cols,scores,parameters)
+
+
+def network_from_score_matrix(matrix,cluster_list,score_threshold,k = 10,beta = 100,compact_graph = False):
+    # Rebuild the molecular families from a ScoreMatrix, as mol_network
+    # would for these score_threshold, k and beta. cluster_list must contain
+    # the clusters the matrix was computed for.
+    if score_threshold < matrix.parameters['score_floor']:
+        raise ValueError("score_threshold {} is below the score floor of the matrix ({})".format(
+            score_threshold,matrix.parameters['score_floor']))
+    clusters_by_id = dict([(c.cluster_id,c) for c in cluster_list])
+    matrix_clusters = [clusters_by_id[cluster_id] for cluster_id in matrix.cluster_ids]
+    keep = np.flatnonzero(matrix.scores >= score_threshold)
+    if compact_graph:
+        G = CSRGraph.from_edges(matrix_clusters,matrix.rows[keep],matrix.cols[keep],matrix.scores[keep]).topk_filter(k = k)
+        return split_families(G,beta)
+    edges = zip(matrix.rows[keep].tolist(),matrix.cols[keep].tolist(),matrix.scores[keep].tolist())
+    G = build_network(matrix_clusters,edges,k = k)
+    return split_families(G,beta)
+
+
+def precursor_windows(sorted_parent_mz,max_shift):
+    # For each position a in a sorted array of parent m/z values, the end of
+    # the window of following positions b with
+    # abs(parent_mz[a] - parent_mz[b]) < max_shift (two-pointer sweep)
+    n = len(sorted_parent_mz)
+    mz = sorted_parent_mz.tolist()
+    window_end = np.zeros(n,dtype = np.int64)
+    end = 0
+    for a in range(n):
+        end = max(end,a+1)
+        while end < n and abs(mz[a] - mz[end]) < max_shift:
+            end += 1
+        window_end[a] = end
+    return window_end
+
+
+def score_rows(packed,order,window_end,start,end,similarity_tolerance,min_match,score_threshold,shift,verbose = False,stats = None,index = None,cache_lookup = None,cache_updates = None):
+    # Score rows start..end-1 of the precursor window sweep: packed holds
+    # the spectra sorted by parent m/z, order maps a sorted position back to
+    # the position in the cluster list and window_end comes from
+    # precursor_windows. Each pair is scored with the spectrum that comes
+    # first in the cluster list as spectrum 1. Returns a list of (i,j,score)
+    # (i < j, cluster list positions) for the pairs that reach score_threshold.
+    # Pruning counters are added to stats (a dict) if given. If index (a
+    # FragmentIndex over packed) is given, only the window pairs it returns
+    # as candidates are scored. cache_lookup is (ScoreCache, parameter key,
+    # spectrum keys of packed); cached scores are used and the keys of the
+    # cached pairs used and the new exact scores are added to the 'used'
+    # and 'new' lists of cache_updates.
+    edges = []
+    for a in range(start,end):
+        if verbose and a%200 == 0 and a > 0:
+            print("Done {} of {}".format(a,len(packed)))
+        b_end = window_end[a]
+        if b_end <= a+1:
+            continue
+        mz,intensity = packed.spectrum_arrays(a)
+        if index is not None:
+            candidates = index.candidates(mz,packed.parent_mz[a],a+1,b_end,min_match)
+            if stats is not None:
+                stats['n_pruned_index'] = stats.get('n_pruned_index',0) + int(b_end - a - 1 - len(candidates))
+        else:
+            candidates = np.arange(a+1,b_end)
+        later = order[candidates] > order[a]
+        scores = np.zeros(len(candidates),dtype = np.float64)
+        to_score = np.ones(len(candidates),dtype = bool)
+        if cache_lookup is not None:
+            cache,parameters,keys = cache_lookup
+            cached = cache.lookup(parameters,keys[a])
+            pair_keys = [(keys[a],keys[b]) if first else (keys[b],keys[a]) for b,first in zip(candidates.tolist(),later.tolist())]
+            for pos,pair_key in enumerate(pair_keys):
+                if pair_key in cached:
+                    scores[pos] = cached[pair_key]
+                    to_score[pos] = False
+                    cache_updates['used'].append(pair_key)
+        for query_first,mask in ((True,later),(False,~later)):
+            positions = np.flatnonzero(mask & to_score)
+            if len(positions) > 0:
+                scores[positions],scored = score_block(mz,intensity,packed.parent_mz[a],packed.take(candidates[positions]),
+                    similarity_tolerance,min_match,shift = shift,query_first = query_first,
+                    score_threshold = score_threshold,stats = stats,return_scored = True)
+                if cache_lookup is not None:
+                    for pos in positions[scored].tolist():
+                        cache_updates['new'].append(pair_keys[pos] + (float(scores[pos]),))
+        for pos in np.flatnonzero(scores >= score_threshold).tolist():
+            i,j = sorted((int(order[a]),int(order[candidates[pos]])))
+            edges.append((i,j,float(scores[pos])))
+    return edges
+
+
+def balanced_blocks(row_pairs,n_blocks):
+    # Split rows into at most n_blocks contiguous (start,end) blocks holding
+    # similar numbers of pairs, given the number of pairs in each row
+    n = len(row_pairs)
+    cumulative = np.cumsum(np.asarray(row_pairs,dtype = np.float64))
+    total = cumulative[-1] if n > 0 else 0.0
+    boundaries = [0]
+    for b in range(1,n_blocks):
+        boundary = int(np.searchsorted(cumulative,total*b/n_blocks,side = 'left')) + 1
+        if boundary > boundaries[-1] and boundary < n:
+            boundaries.append(boundary)
+    boundaries.append(n)
+    return list(zip(boundaries[:-1],boundaries[1:]))
+
+
+def triangular_blocks(n,n_blocks):
+    # balanced blocks for the full upper triangle (row i has n-1-i pairs)
+    return balanced_blocks(np.arange(n-1,-1,-1),n_blocks)
+
+
+# Worker state for parallel scoring, set once per process by
+# _init_score_worker so the spectra are not pickled with every task
+_score_worker_state = {}
+
+def _init_score_worker(mz,intensity,offsets,parent_mz,order,window_end,index,cache_lookup,parameters):
+    _score_worker_state['packed'] = PackedSpectra(mz,intensity,offsets,parent_mz)
+    _score_worker_state['index'] = index
+    _score_worker_state['cache_lookup'] = cache_lookup
+    _score_worker_state['order'] = order
+    _score_worker_state['window_end'] = window_end
+    _score_worker_state['parameters'] = parameters
+
+def _score_worker_rows(block):
+    start,end = block
+    state = _score_worker_state
+    stats = {}
+    cache_updates = {'new': [],'used': []}
+    edges = score_rows(state['packed'],state['order'],state['window_end'],start,end,*state['parameters'],stats = stats,index = state['index'],
+        cache_lookup = state['cache_lookup'],cache_updates = cache_updates)
+    return edges,stats,cache_updates
+
+
+def parallel_score_rows(packed,order,window_end,similarity_tolerance,min_match,score_threshold,shift,n_jobs,blocks_per_job = 4,stats = None,index = None,cache_lookup = None,cache_updates = None):
+    # As score_rows over all rows, using a pool of n_jobs processes. The
+    # rows are split into blocks with balanced numbers of pairs and the
+    # results are merged in block order, so the result is deterministic.
+    from concurrent.futures import ProcessPoolExecutor
+    row_pairs = window_end - np.arange(len(packed)) - 1
+    blocks = balanced_blocks(row_pairs,n_jobs*blocks_per_job)
+    parameters = (similarity_tolerance,min_match,score_threshold,shift)
+    edges = []
+    with ProcessPoolExecutor(max_workers = n_jobs,initializer = _init_score_worker,
+            initargs = (packed.mz,packed.intensity,packed.offsets,packed.parent_mz,order,window_end,index,cache_lookup,parameters)) as executor:
+        for n_done,(block_edges,block_stats,block_cache_updates) in enumerate(executor.map(_score_worker_rows,blocks)):
+            edges += block_edges
+            if cache_updates is not None:
+                cache_updates['new'] += block_cache_updates['new']
+                cache_updates['used'] += block_cache_updates['used']
+            if stats is not None:
+                for key,value in block_stats.items():
+                    stats[key] = stats.get(key,0) + value
+            print("Done block {} of {}".format(n_done+1,len(blocks)))
+    return edges
+
+class UnionFind(object):
+    # Disjoint sets over the integers 0..n-1 (union by size, path halving).
+    # n_components is kept up to date by union.
+    def __init__(self,n):
+        self.parent = list(range(n))
+        self.size = [1]*n
+        self.n_components = n
+
+    def find(self,i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self,i,j):
+        # merge the sets of i and j, returns False if they were already one
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return False
+        if self.size[i] < self.size[j]:
+            i,j = j,i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        self.n_components -= 1
+        return True
+
+    def labels(self):
+        # component label of each element, numbered 0.. in order of the
+        # first element of each component
+        label_of_root = {}
+        labels = []
+        for i in range(len(self.parent)):
+            root = self.find(i)
+            if not root in label_of_root:
+                label_of_root[root] = len(label_of_root)
+            labels.append(label_of_root[root])
+        return labels
+
+
 class Graph(object):
     def __init__(self,edge_dict = {}):
         if not edge_dict:
@@ -600,6 +1199,9 @@ class Graph(object):
         else:
             self.edge_dict = edge_dict
 
+    def __len__(self):
+        return len(self.edge_dict)
+
     def add_node(self,node):
         if not node in self.edge_dict:
             self.edge_dict[node] = set()
@@ -613,124 +1215,320 @@ class Graph(object):
         self.edge_dict[node2].add((node1,weight))
         
     def topk_filter(self,k=10):
-        sorted_edge_dict = {}
+        # Mutual top-k: keep an edge if it is among the k heaviest edges of
+        # both of its nodes (ties in the order sorted() leaves them). Each
+        # node's top k is ranked once so the check is a dictionary lookup.
+        top_edges = {}
+        top_rank = {}
         for node,edges in self.edge_dict.items():
-            sorted_edge_dict[node] = sorted(edges,key = lambda x: x[1], reverse = True)
-        done = set()
+            # nlargest is sorted(...,reverse = True)[:k], ties included
+            top = heapq.nlargest(k,edges,key = lambda x: x[1]) if k > 0 else []
+            top_edges[node] = top
+            top_rank[node] = dict([(edge,pos) for pos,edge in enumerate(top)])
         filtered_edges = {}
-        for node,edges in sorted_edge_dict.items():
-            filtered_edges[node] = []
-            j = 0
-            for node2,weight in edges:
-                other_pos = sorted_edge_dict[node2].index((node,weight))
-                if other_pos < k:
-                    if not node in filtered_edges:
-                        filtered_edges[node] = []
-                    filtered_edges[node].append((node2,weight))
-                j += 1
-                if j == k:
-                    break
+        for node,edges in top_edges.items():
+            filtered_edges[node] = [(node2,weight) for node2,weight in edges if (node,weight) in top_rank[node2]]
+        filtered_graph = Graph(edge_dict = filtered_edges)
         # check for symmetry
-        for node,edges in filtered_edges.items():
+        if not filtered_graph.is_symmetric():
+            print("GAH!")
+        return filtered_graph
+
+    def is_symmetric(self):
+        # True if every edge (node2,weight) of node has (node,weight) in
+        # the edges of node2
+        edge_sets = dict([(node,set(edges)) for node,edges in self.edge_dict.items()])
+        for node,edges in edge_sets.items():
             for node2,weight in edges:
-                if not (node,weight) in filtered_edges[node2]:
-                    print("GAH!")
-        return Graph(edge_dict = filtered_edges)
+                if not node2 in edge_sets or not (node,weight) in edge_sets[node2]:
+                    return False
+        return True
+
+    def node_index(self):
+        # the nodes in edge_dict order and a dict from node to position
+        nodes = list(self.edge_dict.keys())
+        return nodes,dict([(node,i) for i,node in enumerate(nodes)])
+
+    def component_labels(self):
+        # Union-find over the nodes: returns the nodes (edge_dict order), the
+        # component label of each (labels numbered in order of first
+        # appearance) and the number of components
+        nodes,index = self.node_index()
+        components = UnionFind(len(nodes))
+        for node,edges in self.edge_dict.items():
+            i = index[node]
+            for node2,w in edges:
+                components.union(i,index[node2])
+        labels = components.labels()
+        return nodes,labels,components.n_components
 
     def connected_components(self):
-        visited = []
-        to_visit = set(self.edge_dict.keys())
-        while len(to_visit) > 0:
-            current = to_visit.pop()
-            component = self.find_reachable(current)
-            to_visit -= component
-            visited.append(component)
-
+        nodes,labels,n_components = self.component_labels()
         # make the new graph components
-        new_graphs = []
-        for v in visited:
-            new_edges = {}
-            for node in v:
-                new_edges[node] = self.edge_dict[node]
-            new_graphs.append(Graph(edge_dict = new_edges))
-        return new_graphs
+        new_edges = [{} for c in range(n_components)]
+        for node,label in zip(nodes,labels):
+            new_edges[label][node] = self.edge_dict[node]
+        return [Graph(edge_dict = e) for e in new_edges]
 
     def n_connected_components(self):
-        return len(self.connected_components())
+        return self.component_labels()[2]
 
 
     def find_reachable(self,node):
-        visited = set()
-        visited.add(node)
-        to_visit = set([n for n,w in self.edge_dict[node]]) - visited
+        visited = set([node])
+        to_visit = [node]
         while len(to_visit) > 0:
             current = to_visit.pop()
-            visited.add(current)
-            new_nodes = set([n for n,w in self.edge_dict[current]])
-            new_nodes -= visited
-            to_visit = to_visit.union(new_nodes)
+            for n,w in self.edge_dict[current]:
+                if not n in visited:
+                    visited.add(n)
+                    to_visit.append(n)
         return visited
 
     def remove_weakest_edge(self):
-        min_edges = 100.0
+        min_edges = None
         min_n1 = None
-        min_edge = None
         for node,edges in self.edge_dict.items():
-            for pos,(node2,w) in enumerate(edges): 
-                if w < min_edges:
+            for node2,w in edges:
+                if min_edges is None or w < min_edges:
+                    min_edges = w
                     min_n1 = node
-                    min_pos = pos
+                    min_n2 = node2
+        if min_n1 is None:
+            return
+        self.edge_dict[min_n1].remove((min_n2,min_edges))
+        if min_n2 != min_n1:
+            self.edge_dict[min_n2].remove((min_n1,min_edges))
+
+    def edge_list(self):
+        # (node,node2,weight) for each edge once, from the end that comes
+        # first in edge_dict
+        nodes,index = self.node_index()
+        scores = []
+        for i,node in enumerate(nodes):
+            for node2,weight in self.edge_dict[node]:
+                if index[node2] >= i:
+                    scores.append((node,node2,weight))
+        return scores
 
-        min_n2, min_w = self.edge_dict[min_n1][min_pos]
-        del self.edge_dict[min_n1][min_pos]
-        pos2 = self.edge_dict[min_n2].index((min_n1,min_w))
-        del self.edge_dict[min_n2][pos2]
-        
+    def split(self,beta):
+        # Break the graph into components of at most beta nodes, as removing
+        # its weakest edge until it splits in two, and repeating on any part
+        # that is still too big, would (ties are removed in edge_dict order).
+        # See split_edges.
+        nodes,index = self.node_index()
+        edges = [(index[node],index[node2],w) for node,node2,w in self.edge_list()]
+        labels,n_parts,kept = split_edges(len(nodes),edges,beta)
+        kept = set([edge for edge,keep in zip(edges,kept) if keep])
+        new_edges = [{} for c in range(n_parts)]
+        for i,node in enumerate(nodes):
+            new_edges[labels[i]][node] = [(node2,w) for node2,w in self.edge_dict[node] if (min(i,index[node2]),max(i,index[node2]),w) in kept]
+        return [Graph(edge_dict = e) for e in new_edges]
+
+
+class CSRGraph(object):
+    # Compact alternative to Graph: the nodes (clusters) get dense integer
+    # ids and the edges, stored in both directions, are numpy CSR arrays
+    # (indptr, indices, weights) with each row sorted by weight, strongest
+    # first (ties in the order the edges were given). Offers the Graph
+    # methods used by mol_network and MolecularFamily; edge_dict and
+    # to_graph() give the dict form for anything else.
+    def __init__(self,nodes,indptr,indices,weights):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+
+    @classmethod
+    def from_edges(cls,nodes,i,j,weights):
+        # from each edge (i[e],j[e],weights[e]) given once
+        i = np.asarray(i,dtype = np.int64)
+        j = np.asarray(j,dtype = np.int64)
+        weights = np.asarray(weights,dtype = np.float64)
+        back = i != j # a self loop is stored once
+        rows = np.concatenate((i,j[back]))
+        cols = np.concatenate((j,i[back]))
+        both = np.concatenate((weights,weights[back]))
+        order = np.lexsort((-both,rows))
+        indptr = np.zeros(len(nodes)+1,dtype = np.int64)
+        np.cumsum(np.bincount(rows,minlength = len(nodes)),out = indptr[1:])
+        return cls(list(nodes),indptr,cols[order].astype(np.int32),both[order])
+
+    @classmethod
+    def from_graph(cls,G):
+        nodes,index = G.node_index()
+        edges = G.edge_list()
+        return cls.from_edges(nodes,[index[n1] for n1,n2,w in edges],[index[n2] for n1,n2,w in edges],[w for n1,n2,w in edges])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def n_edges(self):
+        return len(self.edge_arrays()[0])
+
+    def rows(self):
+        # the row (node id) of each stored entry
+        return np.repeat(np.arange(len(self.nodes),dtype = np.int64),np.diff(self.indptr))
+
+    def edge_arrays(self):
+        # i,j,weights of each edge once (i <= j), in row order
+        rows = self.rows()
+        once = self.indices >= rows
+        return rows[once],self.indices[once].astype(np.int64),self.weights[once]
+
+    def neighbours(self,i):
+        start,end = self.indptr[i],self.indptr[i+1]
+        return self.indices[start:end],self.weights[start:end]
+
+    def node_index(self):
+        return self.nodes,dict([(node,i) for i,node in enumerate(self.nodes)])
+
+    def edge_list(self):
+        i,j,weights = self.edge_arrays()
+        return [(self.nodes[a],self.nodes[b],w) for a,b,w in zip(i.tolist(),j.tolist(),weights.tolist())]
+
+    @property
+    def edge_dict(self):
+        edge_dict = {}
+        indices = self.indices.tolist()
+        weights = self.weights.tolist()
+        for i,node in enumerate(self.nodes):
+            start,end = self.indptr[i],self.indptr[i+1]
+            edge_dict[node] = [(self.nodes[j],w) for j,w in zip(indices[start:end],weights[start:end])]
+        return edge_dict
+
+    def to_graph(self):
+        return Graph(edge_dict = self.edge_dict)
 
+    def topk_filter(self,k=10):
+        # mutual top-k as Graph.topk_filter: rows are sorted, so an entry's
+        # rank is its offset in the row; keep the edges ranked below k from
+        # both ends
+        rows = self.rows()
+        rank = np.arange(len(self.indices)) - self.indptr[rows]
+        # position of the reverse entry of each entry
+        forward = np.lexsort((self.indices,rows))
+        reverse = np.lexsort((rows,self.indices))
+        other = np.empty(len(rows),dtype = np.int64)
+        other[forward] = reverse
+        keep = (rank < k) & (rank[other] < k) & (self.indices >= rows)
+        return CSRGraph.from_edges(self.nodes,rows[keep],self.indices[keep],self.weights[keep])
+
+    def is_symmetric(self):
+        rows = self.rows()
+        forward = np.lexsort((self.weights,self.indices,rows))
+        reverse = np.lexsort((self.weights,rows,self.indices))
+        return bool(np.array_equal(rows[forward],self.indices[reverse]) and
+            np.array_equal(self.indices[forward],rows[reverse]) and
+            np.array_equal(self.weights[forward],self.weights[reverse]))
+
+    def component_labels(self):
+        i,j,weights = self.edge_arrays()
+        components = UnionFind(len(self.nodes))
+        for a,b in zip(i.tolist(),j.tolist()):
+            components.union(a,b)
+        return self.nodes,components.labels(),components.n_components
 
+    def n_connected_components(self):
+        return self.component_labels()[2]
 
-def mol_network(cluster_list,similarity_function,similarity_tolerance,min_match,score_threshold,k=10,beta=100,mc=1,max_shift = 100):
+    def connected_components(self):
+        nodes,labels,n_components = self.component_labels()
+        return self.subgraphs(labels,n_components,*self.edge_arrays())
+
+    def split(self,beta):
+        # as Graph.split, ties removed in row order
+        i,j,weights = self.edge_arrays()
+        labels,n_parts,kept = split_edges(len(self.nodes),list(zip(i.tolist(),j.tolist(),weights.tolist())),beta)
+        kept = np.array(kept,dtype = bool)
+        return self.subgraphs(labels,n_parts,i[kept],j[kept],weights[kept])
+
+    def subgraphs(self,labels,n_labels,i,j,weights):
+        # a CSRGraph for each label, of its nodes and the edges (i,j,weights)
+        # between them
+        labels = np.asarray(labels,dtype = np.int64)
+        node_order = np.argsort(labels,kind = 'mergesort')
+        starts = np.zeros(n_labels+1,dtype = np.int64)
+        np.cumsum(np.bincount(labels,minlength = n_labels),out = starts[1:])
+        local = np.empty(len(labels),dtype = np.int64)
+        local[node_order] = np.arange(len(labels)) - starts[labels[node_order]]
+        edge_labels = labels[i]
+        edge_order = np.argsort(edge_labels,kind = 'mergesort')
+        edge_starts = np.zeros(n_labels+1,dtype = np.int64)
+        np.cumsum(np.bincount(edge_labels,minlength = n_labels),out = edge_starts[1:])
+        graphs = []
+        for c in range(n_labels):
+            nodes = [self.nodes[n] for n in node_order[starts[c]:starts[c+1]].tolist()]
+            e = edge_order[edge_starts[c]:edge_starts[c+1]]
+            graphs.append(CSRGraph.from_edges(nodes,local[i[e]],local[j[e]],weights[e]))
+        return graphs
+
+
+def split_edges(n_nodes,edges,beta):
+    # The splitting of Graph.split over nodes 0..n_nodes-1 and a list of
+    # edges (i,j,weight), removed weakest first (ties in list order).
+    # Done offline: adding the edges strongest first with a union-find
+    # traces the same splits backwards. A part is final when the merge that
+    # created its parent would exceed beta; it keeps the edges it gained
+    # before that merge. O(E log E) for the sort. Returns the part label of
+    # each node, the number of parts and whether each edge is kept.
+    order = sorted(range(len(edges)),key = lambda e: edges[e][2])
+    order.reverse()
+    full = UnionFind(n_nodes) # the components of the edges added so far
+    parts = UnionFind(n_nodes) # the same, for those of size <= beta
+    frozen = {}
+    for pos,e in enumerate(order):
+        i,j,w = edges[e]
+        root_i = full.find(i)
+        root_j = full.find(j)
+        if root_i == root_j:
+            continue
+        if full.size[root_i] + full.size[root_j] <= beta:
+            parts.union(i,j)
+        else:
+            for root in (root_i,root_j):
+                if full.size[root] <= beta:
+                    frozen[parts.find(root)] = pos
+        full.union(i,j)
+    added = [0]*len(edges)
+    for pos,e in enumerate(order):
+        added[e] = pos
+    kept = []
+    for e,(i,j,w) in enumerate(edges):
+        root = parts.find(i)
+        kept.append(root == parts.find(j) and added[e] < frozen.get(root,len(edges)))
+    return parts.labels(),parts.n_components,kept
+
+
+def mol_network(cluster_list,similarity_function,similarity_tolerance,min_match,score_threshold,k=10,beta=100,mc=1,max_shift = 100,n_jobs = 1,score_cache = None,compact_graph = False):
+    # compact_graph uses CSRGraph rather than Graph for the network and the
+    # returned family graphs
     print()
     print("Computing pairwise similarities (might take some time)")
-    G = make_initial_network(cluster_list,similarity_function,similarity_tolerance,min_match,score_threshold,k=k,mc=mc,max_shift = max_shift)
+    G = make_initial_network(cluster_list,similarity_function,similarity_tolerance,min_match,score_threshold,k=k,mc=mc,max_shift = max_shift,n_jobs = n_jobs,score_cache = score_cache,compact_graph = compact_graph)
+    return split_families(G,beta)
+
 
+def split_families(G,beta = 100):
+    # Split a network into its connected components, breaking any with more
+    # than beta clusters by removing their weakest edges (Graph.split).
+    # Returns the component graphs and the MolecularFamily objects.
 
     # print "Created initial network, {} nodes and {} edges".format(len(G),len(G.edges()))
-    print("Originally {} components".format(G.n_connected_components()))
-    
     molecular_families = G.connected_components()
-
-    finished = False
+    print("Originally {} components".format(len(molecular_families)))
 
     final_families = []
     too_big = []
     for family in molecular_families:
-        if len(family.edge_dict) <= beta:
+        if len(family) <= beta:
             final_families.append(family)
         else:
             too_big.append(family)
 
     print("{} components are too big".format(len(too_big)))
-    while not finished:
-        new_too_big = []
-        for m in too_big:
-            # print "Found component of size = {}".format(len(m))
-            while m.n_connected_components() == 1:
-                m.remove_weakest_edge()
-            # return the two components
-            for c in m.connected_components():
-                if len(c.edge_dict) <= beta:
-                    final_families.append(c)
-                else:
-                    new_too_big.append(c)
-
-        too_big = new_too_big
-        if len(too_big)>0:
-            print("{} components are too big, biggest = {}".format(len(too_big),max([len(m.edge_dict) for m in too_big])))
-
-        if len(too_big) == 0:
-            finished = True
-
+    for m in too_big:
+        final_families += m.split(beta)
 
     print("After pruning, {} components are left".format(len(final_families)))
     return final_families,[MolecularFamily(m,family_id) for family_id,m in enumerate(final_families)]
@@ -747,12 +1545,17 @@ def remove_clusters(cluster_list,files):
     return filtered_cluster_list
 
 def get_spectrum_from_file(input_file,scan_number):
+    # the peaks of a scan (counting the spectra in the file from 0), read
+    # through the scan offset index of the file (see molnet.mzml)
+    if not input_file.endswith('.gz'):
+        from molnet.mzml import ScanIndex
+        return ScanIndex.for_file(input_file).get_peaks(scan_number)
     run = pymzml.run.Reader(input_file,obo_version='4.0.1')
     spec_no = 0
     peaks = []
     for spectrum in run:
         if spec_no == scan_number:
-            if not spectrum['ms level'] == 2:
+            if not spectrum.ms_level == 2:
                 print("Warning: the chosen scan is not MS2!")
             for mz,intensity in spectrum.centroidedPeaks:
                 peaks.append((mz,intensity))
@@ -837,13 +1640,14 @@ def get_family_from_cluster(family_graph_list,cluster):
 
 def test_family(family,similarity_function,similarity_tolerance,score_threshold):
     # for debugging: check to make sure there are no edges below the threshold
+    score_function = get_score_function(similarity_function)
     for cluster in family.clusters:
         max_score = 0.0
         j = 0
         max_pos = -1
         for cluster2 in family.clusters:
             if not (cluster == cluster2):
-                s,_ = similarity_function(cluster,cluster2,similarity_tolerance,3)
+                s = score_function(cluster,cluster2,similarity_tolerance,3)
                 if s >= max_score:
                     max_score = s
                     max_pos = j
@@ -901,23 +1705,25 @@ class SpectralLibrary(object):
             temp_spectra[spec_name]['peaks'].append((m[0],m[2]))
 
         self.spectra = []
+        # large libraries can be held as CompactSpectrum objects
+        spectrum_class = CompactSpectrum if self.loading_parameters.get('compact',False) else Spectrum
         for s in temp_spectra:
             sp = temp_spectra[s]
             if len(sp['peaks']) > 0:
-                self.spectra.append(Spectrum(sp['peaks'],sp['file_name'],sp['scan_number'],
+                self.spectra.append(spectrum_class(sp['peaks'],sp['file_name'],sp['scan_number'],
                                 sp['ms1'],sp['precursor_mz'],sp['rt']))
                 self.spectra[-1].spectrumid = metadata[s]['spectrumid']
                 self.spectra[-1].name = metadata[s]['name']
 
     def filter(self):
-        for s in self.spectra:
-            s.remove_small_peaks(min_ms2_intensity = self.loading_parameters['min_ms2_intensity'])
-            s.remove_precursor_peak(tolerance = self.loading_parameters['precursor_tolerance'])
-            s.keep_top_k(k = self.loading_parameters['k'],mz_range = self.loading_parameters['mz_range'])
+        # remove_small_peaks, remove_precursor_peak and keep_top_k on all the
+        # spectra at once (see molnet.preprocessing)
+        from molnet.preprocessing import Pipeline
+        Pipeline.from_loading_parameters(self.loading_parameters).apply(self.spectra)
 
-        self.spectra = filter(lambda x: x.n_peaks >= self.loading_parameters['N'],self.spectra)
+        self.spectra = list(filter(lambda x: x.n_peaks >= self.loading_parameters['N'],self.spectra))
 
-    def score_spectrum(self,spectrum,similarity_function,similarity_tolerance,min_match_peaks,score_threshold):
+    def score_spectrum(self,spectrum,similarity_function,similarity_tolerance,min_match_peaks,score_threshold,stats = None):
         import bisect
         self.spectra.sort()
         matches = []
@@ -929,10 +1735,21 @@ class SpectralLibrary(object):
         spectrum.precursor_mz -= similarity_tolerance
         
         potential_candidates = range(left_pos,right_pos)
+        batch_function = BATCH_FUNCTIONS.get(similarity_function,None)
+        if batch_function:
+            # the library spectrum is spectrum 1 in the single-pair calls
+            candidates = [self.spectra[p] for p in potential_candidates if abs(self.spectra[p].precursor_mz - spectrum.precursor_mz) < similarity_tolerance]
+            scores = batch_function(spectrum,pack_spectra(candidates),similarity_tolerance,min_match_peaks,
+                query_first = False,score_threshold = score_threshold,stats = stats)
+            for s,sc in zip(candidates,scores.tolist()):
+                if sc >= score_threshold:
+                    matches.append((s,sc))
+            return matches
+        score_function = get_score_function(similarity_function)
         for p in potential_candidates:
             s = self.spectra[p]
             if abs(s.precursor_mz - spectrum.precursor_mz) < similarity_tolerance:
-                sc,m = similarity_function(s,spectrum,similarity_tolerance,min_match_peaks)
+                sc = score_function(s,spectrum,similarity_tolerance,min_match_peaks)
                 if sc >= score_threshold:
                     matches.append((s,sc))
         return matches
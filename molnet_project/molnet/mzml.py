@@ -0,0 +1,264 @@
+# =============================================================================
+# Random access to the spectra of mzML files through a scan offset index
+#
+# index = ScanIndex.for_file('run.mzML') # built once, kept in run.mzML.scanidx.npz
+# peaks = index.get_peaks(3)
+# ms2 = extract_ms2_peaks('run.mzML') # scan number -> peaks, in one pass
+#
+# Scan numbers are positions in the file counting from 0, as in
+# mnet.get_spectrum_from_file. The index holds the byte offset, length and
+# MS level of every <spectrum> element and is checked against the size and
+# modification time of the file before it is used. Gzipped files can't be
+# indexed and are read with a full pass of pymzml instead. References to
+# referenceableParamGroups are replaced by the params of the group, both
+# for the MS levels in the index and in the spectra it parses.
+# =============================================================================
+
+from __future__ import print_function
+
+import os
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pymzml
+
+INDEX_SUFFIX = '.scanidx.npz'
+INDEX_VERSION = 2
+CHUNK_SIZE = 1<<24
+OBO_VERSION = '4.0.1'
+
+# the measured precisions pymzml.run.Reader gives spectra of each MS level
+MS_PRECISIONS = {None: 0.0001,0: 0.0001,1: 5e-6,2: 20e-6,3: 20e-6}
+
+SPECTRUM_START = re.compile(br'<spectrum[\s>]')
+SPECTRUM_END = b'</spectrum>'
+MS_LEVEL = re.compile(br'<cvParam[^>]*"MS:1000511"[^>]*>')
+VALUE = re.compile(br'value="(\d+)"')
+RUN_START = re.compile(br'<run[\s>]')
+NAMESPACE = re.compile(br'<mzML[^>]*\sxmlns="([^"]*)"')
+PARAM_GROUPS = re.compile(br'<referenceableParamGroupList.*?</referenceableParamGroupList>',re.S)
+PARAM_GROUP = re.compile(br'<referenceableParamGroup\s[^>]*?\bid="([^"]*)"[^>]*>(.*?)</referenceableParamGroup>',re.S)
+PARAM_GROUP_REF = re.compile(br'<referenceableParamGroupRef\s[^>]*?\bref="([^"]*)"[^>]*/>')
+
+
+def index_file_name(mzml_file):
+    return mzml_file + INDEX_SUFFIX
+
+
+def file_signature(mzml_file):
+    # what the index is checked against
+    stat = os.stat(mzml_file)
+    return stat.st_size,stat.st_mtime
+
+
+# The spectra of an mzML file by scan number, see the top of the file
+class ScanIndex(object):
+    def __init__(self,mzml_file,offsets,lengths,ms_levels,size,mtime,namespace = '',param_groups = ''):
+        self.mzml_file = mzml_file
+        self.offsets = offsets # byte offset of each <spectrum> element
+        self.lengths = lengths # and its length up to the end of </spectrum>
+        self.ms_levels = ms_levels # MS level of each (0 if it has none)
+        self.size = size
+        self.mtime = mtime
+        self.namespace = namespace
+        self.param_groups = param_groups # the referenceableParamGroupList element, if any
+        self._group_params = None
+
+    @classmethod
+    def build(cls,mzml_file,chunk_size = CHUNK_SIZE):
+        # find the spectra with one pass over the file
+        if mzml_file.endswith('.gz'):
+            raise ValueError("Can't index the gzipped file {}".format(mzml_file))
+        size,mtime = file_signature(mzml_file)
+        offsets = []
+        lengths = []
+        ms_levels = []
+        namespace = None
+        param_groups = b''
+        group_params = {}
+        with open(mzml_file,'rb') as f:
+            buffer = b''
+            buffer_offset = 0 # file offset of buffer[0]
+            while True:
+                chunk = f.read(chunk_size)
+                buffer += chunk
+                if namespace is None:
+                    # the namespace and the param groups come before <run
+                    run = RUN_START.search(buffer)
+                    if run is None and chunk:
+                        continue
+                    header = buffer[:run.start()] if run else buffer
+                    match = NAMESPACE.search(header)
+                    namespace = match.group(1) if match else b''
+                    groups = PARAM_GROUPS.search(header)
+                    param_groups = groups.group(0) if groups else b''
+                    group_params = param_group_params(param_groups)
+                pos = 0
+                while True:
+                    start = SPECTRUM_START.search(buffer,pos)
+                    if start is None:
+                        # keep what could be the start of a split <spectrum
+                        pos = max(pos,len(buffer) - len(b'<spectrum '))
+                        break
+                    start = start.start()
+                    end = buffer.find(SPECTRUM_END,start)
+                    if end == -1:
+                        pos = start
+                        break
+                    end += len(SPECTRUM_END)
+                    offsets.append(buffer_offset + start)
+                    lengths.append(end - start)
+                    ms_levels.append(spectrum_ms_level(buffer,start,end,group_params))
+                    pos = end
+                buffer = buffer[pos:]
+                buffer_offset += pos
+                if not chunk:
+                    break
+        return cls(mzml_file,np.array(offsets,dtype = np.int64),np.array(lengths,dtype = np.int64),
+            np.array(ms_levels,dtype = np.int8),size,mtime,namespace = namespace.decode('utf-8'),
+            param_groups = param_groups.decode('utf-8'))
+
+    @classmethod
+    def load(cls,mzml_file,index_file = None):
+        # the saved index of mzml_file, or None if there isn't one that
+        # matches the file as it is now
+        import json
+        index_file = index_file or index_file_name(mzml_file)
+        if not os.path.exists(index_file):
+            return None
+        try:
+            with np.load(index_file) as data:
+                meta = json.loads(str(data['meta']))
+                if meta['version'] != INDEX_VERSION or (meta['size'],meta['mtime']) != file_signature(mzml_file):
+                    return None
+                return cls(mzml_file,data['offsets'],data['lengths'],data['ms_levels'],meta['size'],meta['mtime'],
+                    namespace = meta['namespace'],param_groups = meta['param_groups'])
+        except (IOError,OSError,ValueError,KeyError):
+            return None
+
+    @classmethod
+    def for_file(cls,mzml_file,index_file = None,save = True):
+        # the index of mzml_file: the saved one if it is still valid, else a
+        # new one (saved next to the file where possible)
+        index = cls.load(mzml_file,index_file = index_file)
+        if index is None:
+            print("Indexing {}".format(mzml_file))
+            index = cls.build(mzml_file)
+            if save:
+                try:
+                    index.save(index_file)
+                except (IOError,OSError) as e:
+                    print("Could not save the index of {}: {}".format(mzml_file,e))
+        return index
+
+    def save(self,index_file = None):
+        import json
+        index_file = index_file or index_file_name(self.mzml_file)
+        meta = json.dumps({'version': INDEX_VERSION,'size': self.size,'mtime': self.mtime,
+            'namespace': self.namespace,'param_groups': self.param_groups})
+        # np.savez would add .npz to other names
+        with open(index_file,'wb') as f:
+            np.savez(f,offsets = self.offsets,lengths = self.lengths,ms_levels = self.ms_levels,meta = np.array(meta))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def ms2_scans(self):
+        return np.flatnonzero(self.ms_levels == 2).tolist()
+
+    def read_elements(self,scan_numbers):
+        # Yield (scan number,<spectrum> element text) for the scans, reading
+        # them in file order with one open file
+        with open(self.mzml_file,'rb') as f:
+            for scan_number in sorted(set(scan_numbers)):
+                f.seek(self.offsets[scan_number])
+                yield scan_number,f.read(self.lengths[scan_number])
+
+    def group_params(self):
+        if self._group_params is None:
+            self._group_params = param_group_params(self.param_groups.encode('utf-8'))
+        return self._group_params
+
+    def parse(self,text):
+        # a pymzml Spectrum from the text of a <spectrum> element
+        if self.param_groups:
+            text = expand_param_groups(text,self.group_params())
+        if self.namespace and not b'xmlns=' in text[:text.find(b'>')]:
+            text = text.replace(b'<spectrum',b'<spectrum xmlns="' + self.namespace.encode('utf-8') + b'"',1)
+        spectrum = pymzml.spec.Spectrum(ET.fromstring(text),obo_version = OBO_VERSION)
+        spectrum.measured_precision = MS_PRECISIONS.get(spectrum.ms_level,MS_PRECISIONS[None])
+        return spectrum
+
+    def get_spectrum(self,scan_number):
+        for scan_number,text in self.read_elements([scan_number]):
+            return self.parse(text)
+
+    def get_peaks(self,scan_number):
+        # the centroided peaks of a scan, as get_spectrum_from_file gives them
+        if scan_number < 0 or scan_number >= len(self):
+            return []
+        spectrum = self.get_spectrum(scan_number)
+        if not spectrum.ms_level == 2:
+            print("Warning: the chosen scan is not MS2!")
+        return spectrum_peaks(spectrum)
+
+    def iter_spectra(self,scan_numbers = None,ms_level = 2):
+        # Yield (scan number,pymzml Spectrum) for the given scans (all the
+        # scans of ms_level if None) in file order
+        if scan_numbers is None:
+            scan_numbers = np.flatnonzero(self.ms_levels == ms_level).tolist()
+        scan_numbers = [s for s in scan_numbers if 0 <= s < len(self)]
+        for scan_number,text in self.read_elements(scan_numbers):
+            yield scan_number,self.parse(text)
+
+
+def param_group_params(param_groups):
+    # the params (element text) of each referenceableParamGroup, by id
+    return dict([(match.group(1),match.group(2)) for match in PARAM_GROUP.finditer(param_groups)])
+
+
+def expand_param_groups(text,group_params):
+    # element text with each referenceableParamGroupRef replaced by the
+    # params of its group (unknown refs are left as they are)
+    return PARAM_GROUP_REF.sub(lambda match: group_params.get(match.group(1),match.group(0)),text)
+
+
+def spectrum_ms_level(buffer,start,end,group_params = None):
+    # the MS level of the spectrum in buffer[start:end], from its own params
+    # or those of the groups it refers to (0 if it has none)
+    match = MS_LEVEL.search(buffer,start,end)
+    if match is None and group_params:
+        for ref in PARAM_GROUP_REF.finditer(buffer,start,end):
+            match = MS_LEVEL.search(group_params.get(ref.group(1),b''))
+            if match:
+                break
+    if match:
+        value = VALUE.search(match.group(0))
+        if value:
+            return int(value.group(1))
+    return 0
+
+
+def spectrum_peaks(spectrum):
+    peaks = []
+    for mz,intensity in spectrum.centroidedPeaks:
+        peaks.append((mz,intensity))
+    return peaks
+
+
+def extract_ms2_peaks(mzml_file,scan_numbers = None,use_index = True):
+    # Peaks of many MS2 scans (all of them if scan_numbers is None) as a
+    # dict of scan number -> peaks, read in one pass: through the index for
+    # plain files, else by iterating over the file once with pymzml
+    if use_index and not mzml_file.endswith('.gz'):
+        index = ScanIndex.for_file(mzml_file)
+        return dict([(scan_number,spectrum_peaks(spectrum)) for scan_number,spectrum in index.iter_spectra(scan_numbers)
+            if spectrum.ms_level == 2])
+    wanted = None if scan_numbers is None else set(scan_numbers)
+    peaks = {}
+    run = pymzml.run.Reader(mzml_file,obo_version = OBO_VERSION)
+    for scan_number,spectrum in enumerate(run):
+        if (wanted is None or scan_number in wanted) and spectrum.ms_level == 2:
+            peaks[scan_number] = spectrum_peaks(spectrum)
+    return peaks
@@ -0,0 +1,255 @@
+# =============================================================================
+# Versioned binary save and load of molecular networks
+#
+# save_network(molecular_families,'results_network.npz',parameters)
+# molecular_families,parameters = load_network('results_network.npz')
+# tables = load_network_tables('results_network.npz') # no spectra
+#
+# The network is stored as tables in one npz file: the families, the
+# clusters (one row each, with their family and a range of member spectra),
+# the spectra (precursor, retention time, file, scan and a range of peaks),
+# the concatenated peaks and the edges of each family as (source row,target
+# row,score) triplets, plus a json header with the format version, the
+# parameters and anything that doesn't fit a column. Each object is stored
+# once, however many families refer to it. load_network rebuilds the
+# MolecularFamily, Cluster and Spectrum objects; load_network_tables reads
+# just the family and edge tables.
+# =============================================================================
+
+from __future__ import print_function
+
+import json
+
+import numpy as np
+
+from molnet.mnet import Spectrum,CompactSpectrum,Cluster,MolecularFamily,Annotation
+from molnet.library_store import StorePrecursor
+
+FORMAT = 'molnet-network'
+FORMAT_VERSION = 1
+
+
+def _json_default(x):
+    # numpy scalars as plain numbers, anything else json can't take as text
+    return x.item() if hasattr(x,'item') else str(x)
+
+
+def _optional(values):
+    # a float column with nan for the missing values
+    return np.array([np.nan if v is None else v for v in values],dtype = np.float64)
+
+
+def _restore_optional(value):
+    return None if np.isnan(value) else value
+
+
+def _id_column(values):
+    # ints stay ints; anything else (strings, a mix, None) is kept as text
+    # and its values listed in the header
+    if all(isinstance(v,(int,np.integer)) and not isinstance(v,bool) for v in values):
+        return np.array(values,dtype = np.int64),None
+    return np.zeros(len(values),dtype = np.int64),[v if v is None or isinstance(v,(int,float,str)) else str(v) for v in values]
+
+
+def save_network(molecular_families,file_name,parameters = None):
+    clusters = []
+    cluster_rows = {} # id(cluster) -> row
+    cluster_family = []
+    family_ids = []
+    edge_offsets = [0]
+    sources = []
+    targets = []
+    weights = []
+    for family_pos,family in enumerate(molecular_families):
+        family_ids.append(family.family_id)
+        for cluster in family.clusters:
+            if not id(cluster) in cluster_rows:
+                cluster_rows[id(cluster)] = len(clusters)
+                clusters.append(cluster)
+                cluster_family.append(family_pos)
+        for cluster1,cluster2,weight in family.scores:
+            sources.append(cluster_rows[id(cluster1)])
+            targets.append(cluster_rows[id(cluster2)])
+            weights.append(weight)
+        edge_offsets.append(len(sources))
+    # family.clusters in order, for the (rare) families that share clusters
+    family_members = [[cluster_rows[id(c)] for c in family.clusters] for family in molecular_families]
+
+    spectra = []
+    member_offsets = [0]
+    for cluster in clusters:
+        spectra += cluster.spectra
+        member_offsets.append(len(spectra))
+    file_names = sorted(set([s.file_name for s in spectra]),key = str)
+    file_index = dict([(f,i) for i,f in enumerate(file_names)])
+    peak_offsets = np.zeros(len(spectra)+1,dtype = np.int64)
+    mz_list = []
+    intensity_list = []
+    metadata = {}
+    for i,spectrum in enumerate(spectra):
+        if isinstance(spectrum,CompactSpectrum):
+            mz,intensity = spectrum.mz,spectrum.intensity.astype(np.float64)
+        else:
+            mz = np.array([p[0] for p in spectrum.peaks],dtype = np.float64)
+            intensity = np.array([p[1] for p in spectrum.peaks],dtype = np.float64)
+        mz_list.append(mz)
+        intensity_list.append(intensity)
+        peak_offsets[i+1] = peak_offsets[i] + len(mz)
+        if spectrum.metadata:
+            spectrum_metadata = dict(spectrum.metadata)
+            if 'annotation' in spectrum_metadata:
+                spectrum_metadata['annotation'] = [a.metadata for a in spectrum_metadata['annotation']]
+            metadata[str(i)] = spectrum_metadata
+    cluster_ids,cluster_id_values = _id_column([c.cluster_id for c in clusters])
+    scan_numbers,scan_number_values = _id_column([s.scan_number for s in spectra])
+    charges = [getattr(s.ms1,'charge',None) for s in spectra]
+
+    header = {
+        'format': FORMAT,
+        'version': FORMAT_VERSION,
+        'parameters': parameters,
+        'family_ids': family_ids,
+        'file_names': file_names,
+        'cluster_ids': cluster_id_values,
+        'scan_numbers': scan_number_values,
+        'compact': [i for i,s in enumerate(spectra) if isinstance(s,CompactSpectrum)],
+        'metadata': metadata,
+    }
+    empty = [np.zeros(0,dtype = np.float64)]
+    tables = {
+        'header': np.array(json.dumps(header,default = _json_default)),
+        # families and edges
+        'edge_offsets': np.array(edge_offsets,dtype = np.int64),
+        'edge_source': np.array(sources,dtype = np.int64),
+        'edge_target': np.array(targets,dtype = np.int64),
+        'edge_weight': np.array(weights,dtype = np.float64),
+        'family_member_offsets': np.cumsum([0] + [len(m) for m in family_members]).astype(np.int64),
+        'family_members': np.array(sum(family_members,[]),dtype = np.int64),
+        # clusters
+        'cluster_id': cluster_ids,
+        'cluster_family': np.array(cluster_family,dtype = np.int64),
+        'cluster_precursor_mz': np.array([c.precursor_mz for c in clusters],dtype = np.float64),
+        'cluster_parent_mz': np.array([c.parent_mz for c in clusters],dtype = np.float64),
+        'member_offsets': np.array(member_offsets,dtype = np.int64),
+        # spectra and their peaks
+        'spectrum_file': np.array([file_index[s.file_name] for s in spectra],dtype = np.int64),
+        'spectrum_scan': scan_numbers,
+        'spectrum_precursor_mz': np.array([s.precursor_mz for s in spectra],dtype = np.float64),
+        'spectrum_parent_mz': np.array([s.parent_mz for s in spectra],dtype = np.float64),
+        'spectrum_rt': _optional([s.rt for s in spectra]),
+        'spectrum_precursor_intensity': _optional([s.precursor_intensity for s in spectra]),
+        'spectrum_charge': _optional(charges),
+        'peak_offsets': peak_offsets,
+        'peak_mz': np.concatenate(empty + mz_list),
+        'peak_intensity': np.concatenate(empty + intensity_list),
+    }
+    # np.savez would add .npz to other names
+    with open(file_name,'wb') as f:
+        np.savez(f,**tables)
+
+
+def _read_header(data,file_name):
+    header = json.loads(str(data['header']))
+    if header.get('format') != FORMAT:
+        raise ValueError("{} is not a saved molecular network".format(file_name))
+    if header['version'] > FORMAT_VERSION:
+        raise ValueError("{} was saved in format version {}, this version of molnet reads up to {}".format(
+            file_name,header['version'],FORMAT_VERSION))
+    return header
+
+
+class NetworkTables(object):
+    # The family and edge tables of a saved network, without the spectra.
+    # Edges are (source cluster id,target cluster id,score) and the edges
+    # of family i are rows edge_offsets[i]:edge_offsets[i+1].
+    def __init__(self,family_ids,cluster_ids,cluster_family_ids,precursor_mz,parent_mz,edge_offsets,source,target,weight,parameters):
+        self.family_ids = family_ids
+        self.cluster_ids = cluster_ids
+        self.cluster_family_ids = cluster_family_ids
+        self.precursor_mz = precursor_mz
+        self.parent_mz = parent_mz
+        self.edge_offsets = edge_offsets
+        self.source = source
+        self.target = target
+        self.weight = weight
+        self.parameters = parameters
+
+    def edges(self):
+        # (source cluster id,target cluster id,score,family id) rows
+        edge_family = np.repeat(np.arange(len(self.family_ids)),np.diff(self.edge_offsets))
+        return [(self.source[i],self.target[i],w,self.family_ids[f]) for i,(w,f) in enumerate(zip(self.weight.tolist(),edge_family.tolist()))]
+
+
+def load_network_tables(file_name):
+    # Only the arrays named here are read from the file
+    with np.load(file_name) as data:
+        header = _read_header(data,file_name)
+        cluster_ids = header['cluster_ids'] if header['cluster_ids'] is not None else data['cluster_id'].tolist()
+        family_ids = header['family_ids']
+        cluster_family = data['cluster_family'].tolist()
+        source = [cluster_ids[i] for i in data['edge_source'].tolist()]
+        target = [cluster_ids[i] for i in data['edge_target'].tolist()]
+        return NetworkTables(family_ids,cluster_ids,[family_ids[f] for f in cluster_family],
+            data['cluster_precursor_mz'],data['cluster_parent_mz'],data['edge_offsets'],
+            source,target,data['edge_weight'],header['parameters'])
+
+
+def load_network(file_name):
+    # the MolecularFamily objects (with their clusters and spectra) and the
+    # parameters of a network saved by save_network
+    with np.load(file_name) as data:
+        header = _read_header(data,file_name)
+        arrays = dict([(name,data[name]) for name in data.files if name != 'header'])
+    file_names = header['file_names']
+    compact = set(header['compact'])
+    scan_numbers = header['scan_numbers'] if header['scan_numbers'] is not None else arrays['spectrum_scan'].tolist()
+    cluster_ids = header['cluster_ids'] if header['cluster_ids'] is not None else arrays['cluster_id'].tolist()
+    peak_offsets = arrays['peak_offsets']
+    peak_mz = arrays['peak_mz']
+    peak_intensity = arrays['peak_intensity']
+    mz_list = peak_mz.tolist()
+    intensity_list = peak_intensity.tolist()
+
+    spectra = []
+    for i in range(len(scan_numbers)):
+        lo,hi = int(peak_offsets[i]),int(peak_offsets[i+1])
+        precursor_mz = float(arrays['spectrum_precursor_mz'][i])
+        charge = _restore_optional(arrays['spectrum_charge'][i])
+        ms1 = StorePrecursor(precursor_mz,charge = None if charge is None else int(charge))
+        metadata = header['metadata'].get(str(i),None)
+        if metadata and 'annotation' in metadata:
+            metadata['annotation'] = [Annotation(a) for a in metadata['annotation']]
+        args = (file_names[arrays['spectrum_file'][i]],scan_numbers[i],ms1,precursor_mz,float(arrays['spectrum_parent_mz'][i]))
+        kwargs = {'rt': _restore_optional(float(arrays['spectrum_rt'][i])),
+            'precursor_intensity': _restore_optional(float(arrays['spectrum_precursor_intensity'][i])),
+            'metadata': metadata if metadata is not None else {}}
+        if i in compact:
+            spectra.append(CompactSpectrum((peak_mz[lo:hi].copy(),peak_intensity[lo:hi].copy()),*args,**kwargs))
+        else:
+            spectra.append(Spectrum(list(zip(mz_list[lo:hi],intensity_list[lo:hi])),*args,**kwargs))
+
+    clusters = []
+    member_offsets = arrays['member_offsets'].tolist()
+    for row,cluster_id in enumerate(cluster_ids):
+        members = spectra[member_offsets[row]:member_offsets[row+1]]
+        cluster = Cluster(members[0],cluster_id)
+        # the members in their saved order, which set_prototype gave them
+        cluster.spectra = members
+        cluster.n_spectra = len(members)
+        cluster._totals = None
+        cluster._file_counts = None
+        cluster.set_prototype_fields()
+        clusters.append(cluster)
+
+    families = []
+    edge_offsets = arrays['edge_offsets'].tolist()
+    member_offsets = arrays['family_member_offsets'].tolist()
+    sources = arrays['edge_source'].tolist()
+    targets = arrays['edge_target'].tolist()
+    weights = arrays['edge_weight'].tolist()
+    members = arrays['family_members'].tolist()
+    for pos,family_id in enumerate(header['family_ids']):
+        edges = range(edge_offsets[pos],edge_offsets[pos+1])
+        families.append(MolecularFamily.from_scores([clusters[r] for r in members[member_offsets[pos]:member_offsets[pos+1]]],
+            [(clusters[sources[e]],clusters[targets[e]],weights[e]) for e in edges],family_id))
+    return families,header['parameters']
@@ -0,0 +1,170 @@
+# =============================================================================
+# Preprocessing of whole spectrum collections: an ordered chain of the
+# Spectrum filters applied to all the peaks at once, packed into arrays. The
+# spectra only get their final peaks, so their derived fields (normalised
+# peaks, max and total intensity) are worked out once, when next needed
+# =============================================================================
+
+from __future__ import print_function
+
+import numpy as np
+
+from molnet.mnet import CompactSpectrum
+
+
+def top_k_in_window(mz,intensity,k,mz_range):
+    # Mask of the peaks (sorted by mz) that have fewer than k strictly more
+    # intense peaks within +- mz_range, as Spectrum.keep_top_k keeps them
+    mz = np.asarray(mz,dtype = np.float64)
+    return top_k_in_windows(mz,np.asarray(intensity),np.array([0,len(mz)]),k,mz_range)
+
+
+def top_k_in_windows(mz,intensity,offsets,k,mz_range,max_block = 1<<22):
+    # top_k_in_window for each spectrum of packed peaks (spectrum i has
+    # peaks offsets[i]:offsets[i+1]). The windows are found by bisection and
+    # each peak is compared with its window as one vectorised block of at
+    # most max_block comparisons at a time. The peaks are grouped by the
+    # width of their own window, rounded up to a power of two, and each group
+    # is padded only to its own width, so that one dense spectrum doesn't
+    # make every other peak pay for its wide windows.
+    n = len(mz)
+    starts = np.zeros(n,dtype = np.int64)
+    ends = np.zeros(n,dtype = np.int64)
+    for i in range(len(offsets)-1):
+        lo,hi = offsets[i],offsets[i+1]
+        spectrum_mz = mz[lo:hi]
+        starts[lo:hi] = lo + np.searchsorted(spectrum_mz,spectrum_mz - mz_range,side = 'left')
+        ends[lo:hi] = lo + np.searchsorted(spectrum_mz,spectrum_mz + mz_range,side = 'right')
+    keep = np.zeros(n,dtype = bool)
+    if n == 0:
+        return keep
+    widths = np.maximum(ends - starts,1)
+    buckets = np.ceil(np.log2(widths)).astype(np.int64)
+    for bucket in np.unique(buckets):
+        peaks = np.flatnonzero(buckets == bucket)
+        width = 1<<int(bucket)
+        block = max(1,max_block//width)
+        for pos in range(0,len(peaks),block):
+            rows = peaks[pos:pos + block]
+            window = starts[rows,None] + np.arange(width)
+            inside = window < ends[rows,None]
+            window[~inside] = rows[0]
+            n_bigger = np.count_nonzero((intensity[window] > intensity[rows,None]) & inside,axis = 1)
+            keep[rows] = n_bigger < k
+    return keep
+
+
+class PeakArrays(object):
+    # The raw peaks of a collection of spectra, concatenated: the peaks of
+    # spectrum i are mz[offsets[i]:offsets[i+1]] (sorted by mz)
+    def __init__(self,mz,intensity,offsets,precursor_mz):
+        self.mz = mz
+        self.intensity = intensity
+        self.offsets = offsets
+        self.precursor_mz = precursor_mz
+
+    @classmethod
+    def from_spectra(cls,spectra):
+        mz_list = []
+        intensity_list = []
+        offsets = np.zeros(len(spectra)+1,dtype = np.int64)
+        for i,spectrum in enumerate(spectra):
+            if isinstance(spectrum,CompactSpectrum):
+                mz,intensity = spectrum.mz,spectrum.intensity.astype(np.float64)
+            else:
+                mz = np.array([p[0] for p in spectrum.peaks],dtype = np.float64)
+                intensity = np.array([p[1] for p in spectrum.peaks],dtype = np.float64)
+            mz_list.append(mz)
+            intensity_list.append(intensity)
+            offsets[i+1] = offsets[i] + len(mz)
+        empty = [np.zeros(0,dtype = np.float64)]
+        precursor_mz = np.array([s.precursor_mz for s in spectra],dtype = np.float64)
+        return cls(np.concatenate(empty + mz_list),np.concatenate(empty + intensity_list),offsets,precursor_mz)
+
+    def owners(self):
+        # the spectrum of each peak
+        return np.repeat(np.arange(len(self.offsets)-1),np.diff(self.offsets))
+
+    def select(self,keep):
+        # a new PeakArrays with only the peaks in the boolean mask keep
+        offsets = np.zeros(len(self.offsets),dtype = np.int64)
+        np.cumsum(np.bincount(self.owners()[keep],minlength = len(self.offsets)-1),out = offsets[1:])
+        return PeakArrays(self.mz[keep],self.intensity[keep],offsets,self.precursor_mz)
+
+
+def remove_small_peaks(peaks,min_ms2_intensity = 10000):
+    return peaks.select(peaks.intensity >= min_ms2_intensity)
+
+
+def remove_precursor_peak(peaks,tolerance = 17):
+    return peaks.select(np.abs(peaks.mz - peaks.precursor_mz[peaks.owners()]) > tolerance)
+
+
+def keep_top_k(peaks,k = 6,mz_range = 50):
+    return peaks.select(top_k_in_windows(peaks.mz,peaks.intensity,peaks.offsets,k,mz_range))
+
+
+def normalise_max_intensity(peaks,max_intensity = 1000.0):
+    n_peaks = np.diff(peaks.offsets)
+    spectrum_max = np.zeros(len(n_peaks),dtype = np.float64)
+    present = n_peaks > 0
+    spectrum_max[present] = np.maximum.reduceat(peaks.intensity,peaks.offsets[:-1][present])
+    # spectra without intensity (all peaks 0) are left as they are
+    owner_max = spectrum_max[peaks.owners()]
+    positive = owner_max > 0
+    intensity = np.where(positive,max_intensity*(peaks.intensity/np.where(positive,owner_max,1.0)),peaks.intensity)
+    return PeakArrays(peaks.mz,intensity,peaks.offsets,peaks.precursor_mz)
+
+
+FILTERS = {
+    'remove_small_peaks': remove_small_peaks,
+    'remove_precursor_peak': remove_precursor_peak,
+    'keep_top_k': keep_top_k,
+    'normalise_max_intensity': normalise_max_intensity,
+}
+
+
+class Pipeline(object):
+    # An ordered chain of filters, given as (name,keyword arguments) pairs
+    # with the names and arguments of the Spectrum methods, e.g.
+    #
+    # Pipeline([('remove_small_peaks',{'min_ms2_intensity': 1000}),
+    #           ('keep_top_k',{'k': 6,'mz_range': 50})]).apply(spectra)
+    #
+    # leaves the spectra as calling those methods in turn on each would.
+    def __init__(self,steps):
+        self.steps = []
+        for name,kwargs in steps:
+            if not name in FILTERS:
+                raise ValueError("Unknown filter {}, expected one of {}".format(name,", ".join(sorted(FILTERS))))
+            self.steps.append((name,dict(kwargs)))
+
+    @classmethod
+    def from_loading_parameters(cls,loading_parameters):
+        # the filter chain of SpectralLibrary.filter
+        return cls([
+            ('remove_small_peaks',{'min_ms2_intensity': loading_parameters['min_ms2_intensity']}),
+            ('remove_precursor_peak',{'tolerance': loading_parameters['precursor_tolerance']}),
+            ('keep_top_k',{'k': loading_parameters['k'],'mz_range': loading_parameters['mz_range']}),
+        ])
+
+    def run(self,peaks):
+        # apply the chain to a PeakArrays
+        for name,kwargs in self.steps:
+            peaks = FILTERS[name](peaks,**kwargs)
+        return peaks
+
+    def apply(self,spectra):
+        # filter the spectra (Spectrum or CompactSpectrum) in place
+        spectra = list(spectra)
+        peaks = self.run(PeakArrays.from_spectra(spectra))
+        mz = peaks.mz.tolist()
+        intensity = peaks.intensity.tolist()
+        for i,spectrum in enumerate(spectra):
+            lo,hi = peaks.offsets[i],peaks.offsets[i+1]
+            if isinstance(spectrum,CompactSpectrum):
+                spectrum._set_peaks(peaks.mz[lo:hi].copy(),peaks.intensity[lo:hi].astype(spectrum.intensity.dtype))
+            else:
+                spectrum.peaks = list(zip(mz[lo:hi],intensity[lo:hi]))
+        return spectra
+
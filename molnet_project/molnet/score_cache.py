@@ -0,0 +1,106 @@
+# =============================================================================
+# Persistent store of pairwise scores, so that rebuilding a network with a
+# different score_threshold or k doesn't rescore every pair
+# =============================================================================
+
+from __future__ import print_function
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+def parameter_key(similarity_function,similarity_tolerance,min_match):
+    # scores are only reused for the same function, tolerance and min_match
+    return "{}:{!r}:{}".format(similarity_function.__name__,float(similarity_tolerance),int(min_match))
+
+
+def spectrum_keys(packed):
+    # content hash of each spectrum in a PackedSpectra block: the normalised
+    # peaks and the parent m/z (which sets the shift)
+    keys = []
+    for pos in range(len(packed)):
+        mz,intensity = packed.spectrum_arrays(pos)
+        h = hashlib.sha1()
+        h.update(mz.tobytes())
+        h.update(intensity.tobytes())
+        h.update(repr(float(packed.parent_mz[pos])).encode('ascii'))
+        keys.append(h.hexdigest())
+    return keys
+
+
+class ScoreCache(object):
+    # An sqlite file of (parameters, key1, key2) -> score, where key1 and
+    # key2 are the content hashes of spectrum 1 and spectrum 2. Only exact
+    # scores are stored (never pairs that were pruned against a threshold).
+    # When the file holds more than max_entries scores the least recently
+    # used are removed. Each thread (Django serves each request on its own)
+    # gets its own connection to the file.
+    def __init__(self,filename,max_entries = 5000000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # connections can't be pickled (e.g. when sent to worker processes)
+        state = dict(self.__dict__)
+        del state['_local']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._local,'connection',None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename,timeout = 60)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""CREATE TABLE IF NOT EXISTS scores (
+                parameters TEXT, key1 TEXT, key2 TEXT, score REAL, last_used REAL,
+                PRIMARY KEY (parameters,key1,key2))""")
+            connection.execute("CREATE INDEX IF NOT EXISTS scores_key2 ON scores (parameters,key2)")
+            connection.execute("CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        # closes the connection of the calling thread
+        connection = getattr(self._local,'connection',None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def lookup(self,parameters,key):
+        # all stored scores of pairs involving the spectrum with this key,
+        # as a dict {(key1,key2): score}
+        rows = self._connect().execute("""SELECT key1,key2,score FROM scores WHERE parameters = ? AND key1 = ?
+            UNION ALL SELECT key1,key2,score FROM scores WHERE parameters = ? AND key2 = ?""",
+            (parameters,key,parameters,key))
+        return dict([((key1,key2),score) for key1,key2,score in rows])
+
+    def store(self,parameters,scores,used = None):
+        # add new (key1,key2,score) scores and mark the (key1,key2) pairs in
+        # used as recently used, then evict if the cache has grown too big
+        now = time.time()
+        connection = self._connect()
+        connection.executemany("INSERT OR REPLACE INTO scores VALUES (?,?,?,?,?)",
+            [(parameters,key1,key2,score,now) for key1,key2,score in scores])
+        if used:
+            connection.executemany("UPDATE scores SET last_used = ? WHERE parameters = ? AND key1 = ? AND key2 = ?",
+                [(now,parameters,key1,key2) for key1,key2 in used])
+        connection.commit()
+        self.evict()
+
+    def evict(self):
+        connection = self._connect()
+        n_extra = len(self) - self.max_entries
+        if n_extra > 0:
+            connection.execute("DELETE FROM scores WHERE rowid IN (SELECT rowid FROM scores ORDER BY last_used LIMIT ?)",(n_extra,))
+            connection.commit()
+            print("Removed {} old scores from the score cache".format(n_extra))
@@ -4,6 +4,8 @@
 
 from __future__ import print_function
 
+import numpy as np
+
 
 def fast_cosine_shift(spectrum1,spectrum2,tol,min_match):
     if spectrum1.n_peaks == 0 or spectrum2.n_peaks == 0:
@@ -83,6 +85,427 @@ def fast_cosine(spectrum1,spectrum2,tol,min_match):
         score = 0.0
     return score,used_matches
 
+# =============================================================================
+# Score-only kernel: the same scores without building the list of matches
+# =============================================================================
+
+def _score_only(spectrum1,spectrum2,tol,min_match,use_shift):
+    if spectrum1.n_peaks == 0 or spectrum2.n_peaks == 0:
+        return 0.0
+
+    spec1 = spectrum1.normalised_peaks
+    spec2 = spectrum2.normalised_peaks
+    n1 = len(spec1)
+    n2 = len(spec2)
+    shift = spectrum1.parent_mz - spectrum2.parent_mz
+
+    # One pass over spec1 finding the unshifted and shifted pairs together,
+    # with the same conditions as find_pairs. Pairs are kept as flat lists
+    # of products and positions (i*n2 + j) rather than tuples.
+    products = []
+    positions = []
+    shift_products = []
+    shift_positions = []
+    low = 0
+    shift_low = 0
+    for idx,(mz,intensity) in enumerate(spec1):
+        lower = mz - tol
+        upper = mz + tol
+        while low < n2 and spec2[low][0] < lower:
+            low += 1
+        pos = low
+        while pos < n2 and spec2[pos][0] < upper:
+            products.append(intensity*spec2[pos][1])
+            positions.append(idx*n2 + pos)
+            pos += 1
+        if use_shift:
+            while shift_low < n2 and spec2[shift_low][0] + shift < lower:
+                shift_low += 1
+            pos = shift_low
+            while pos < n2 and spec2[pos][0] + shift < upper:
+                shift_products.append(intensity*spec2[pos][1])
+                shift_positions.append(idx*n2 + pos)
+                pos += 1
+
+    # the unshifted pairs come first, as in fast_cosine_shift
+    products += shift_products
+    positions += shift_positions
+
+    # sorting positions by product is stable, like sorting the match tuples
+    used1 = set()
+    used2 = set()
+    score = 0.0
+    max_used = min(n1,n2)
+    for k in sorted(range(len(products)),key = products.__getitem__,reverse = True):
+        i,j = divmod(positions[k],n2)
+        if not i in used1 and not j in used2:
+            score += products[k]
+            used1.add(i)
+            used2.add(j)
+            if len(used1) == max_used:
+                break # no peaks left to match
+
+    if len(used1) < min_match:
+        score = 0.0
+    return score
+
+
+def fast_cosine_score(spectrum1,spectrum2,tol,min_match):
+    # the score of fast_cosine, without the list of matches
+    return _score_only(spectrum1,spectrum2,tol,min_match,False)
+
+
+def fast_cosine_shift_score(spectrum1,spectrum2,tol,min_match):
+    # the score of fast_cosine_shift, without the list of matches
+    return _score_only(spectrum1,spectrum2,tol,min_match,True)
+
+
+# the score-only equivalent of each scoring function; use the full
+# functions when the matches are needed (e.g. plot_spectral_alignment)
+SCORE_FUNCTIONS = {
+    fast_cosine: fast_cosine_score,
+    fast_cosine_shift: fast_cosine_shift_score,
+}
+
+
+def get_score_function(similarity_function):
+    # a function returning just the score of similarity_function
+    if similarity_function in SCORE_FUNCTIONS:
+        return SCORE_FUNCTIONS[similarity_function]
+    def score_function(spectrum1,spectrum2,tol,min_match):
+        return similarity_function(spectrum1,spectrum2,tol,min_match)[0]
+    return score_function
+
+
+# =============================================================================
+# Batched scoring: one query against a block of packed candidate spectra
+# =============================================================================
+
+class PackedSpectra(object):
+    # A block of spectra with their normalised peaks concatenated into
+    # contiguous arrays. The peaks of spectrum i are
+    # mz[offsets[i]:offsets[i+1]] (and the same slice of intensity)
+    def __init__(self,mz,intensity,offsets,parent_mz):
+        self.mz = mz
+        self.intensity = intensity
+        self.offsets = offsets
+        self.parent_mz = parent_mz
+
+    def __len__(self):
+        return len(self.parent_mz)
+
+    def n_peaks(self):
+        return np.diff(self.offsets)
+
+    def slice(self,start,end = None):
+        # a view on spectra start..end-1 (the peak arrays are not copied)
+        if end is None:
+            end = len(self)
+        lo = self.offsets[start]
+        hi = self.offsets[end]
+        return PackedSpectra(self.mz[lo:hi],self.intensity[lo:hi],
+            self.offsets[start:end+1] - lo,self.parent_mz[start:end])
+
+    def spectrum_arrays(self,pos):
+        # the normalised (mz,intensity) arrays of spectrum pos
+        lo = self.offsets[pos]
+        hi = self.offsets[pos+1]
+        return self.mz[lo:hi],self.intensity[lo:hi]
+
+    def take(self,indices):
+        # a new block holding just the spectra in indices (copies the peaks)
+        indices = np.asarray(indices,dtype = np.int64)
+        n_peaks = self.n_peaks()[indices]
+        offsets = np.zeros(len(indices)+1,dtype = np.int64)
+        np.cumsum(n_peaks,out = offsets[1:])
+        run_start = np.repeat(self.offsets[indices] - offsets[:-1],n_peaks)
+        peak_pos = np.arange(offsets[-1]) + run_start
+        return PackedSpectra(self.mz[peak_pos],self.intensity[peak_pos],
+            offsets,self.parent_mz[indices])
+
+
+def normalised_arrays(spectrum):
+    # the normalised peaks of a spectrum (or of a cluster's prototype)
+    # as two float64 arrays
+    prototype = getattr(spectrum,'spectrum',spectrum)
+    if hasattr(prototype,'normalised_arrays'):
+        # CompactSpectrum: already held as arrays
+        return prototype.normalised_arrays()
+    peaks = spectrum.normalised_peaks
+    mz = np.array([p[0] for p in peaks],dtype = np.float64)
+    intensity = np.array([p[1] for p in peaks],dtype = np.float64)
+    return mz,intensity
+
+
+def pack_spectra(spectra):
+    # pack a list of spectra (or clusters) into a PackedSpectra block
+    mz_list = []
+    intensity_list = []
+    offsets = np.zeros(len(spectra)+1,dtype = np.int64)
+    for i,spectrum in enumerate(spectra):
+        mz,intensity = normalised_arrays(spectrum)
+        mz_list.append(mz)
+        intensity_list.append(intensity)
+        offsets[i+1] = offsets[i] + len(mz)
+    if len(spectra) > 0:
+        mz = np.concatenate(mz_list)
+        intensity = np.concatenate(intensity_list)
+    else:
+        mz = np.zeros(0,dtype = np.float64)
+        intensity = np.zeros(0,dtype = np.float64)
+    parent_mz = np.array([s.parent_mz for s in spectra],dtype = np.float64)
+    return PackedSpectra(mz,intensity,offsets,parent_mz)
+
+
+def concatenate_packed(blocks):
+    # join PackedSpectra blocks into one, in order
+    blocks = list(blocks)
+    offsets = [np.zeros(1,dtype = np.int64)]
+    start = 0
+    for block in blocks:
+        offsets.append(block.offsets[1:] + start)
+        start += block.offsets[-1]
+    return PackedSpectra(np.concatenate([np.zeros(0,dtype = np.float64)] + [b.mz for b in blocks]),
+        np.concatenate([np.zeros(0,dtype = np.float64)] + [b.intensity for b in blocks]),
+        np.concatenate(offsets),np.concatenate([np.zeros(0,dtype = np.float64)] + [b.parent_mz for b in blocks]))
+
+
+def find_pairs_batch(mz1,intensity1,block,shifts,tol):
+    # Vectorised find_pairs for one spectrum against every spectrum in block.
+    # Peak j of a candidate matches peak i of spectrum 1 when
+    # mz1[i] - tol <= mz2[j] + shift < mz1[i] + tol, exactly the condition
+    # used by find_pairs. Returns (candidate, i, j, product) arrays with j
+    # relative to the start of the candidate's peaks.
+    n_peaks = block.n_peaks()
+    candidate = np.repeat(np.arange(len(block)),n_peaks)
+    shifted = block.mz + shifts[candidate]
+    lower = mz1 - tol
+    upper = mz1 + tol
+    first_i = np.searchsorted(upper,shifted,side = 'right')
+    last_i = np.searchsorted(lower,shifted,side = 'right')
+    counts = np.maximum(last_i - first_i,0)
+    n_pairs = counts.sum()
+    peak_pos = np.repeat(np.arange(len(shifted)),counts)
+    # position of each pair within its run of spectrum 1 peaks
+    run_start = np.cumsum(counts) - counts
+    i = first_i[peak_pos] + np.arange(n_pairs) - run_start[peak_pos]
+    cand = candidate[peak_pos]
+    j = peak_pos - block.offsets[cand]
+    product = intensity1[i]*block.intensity[peak_pos]
+    return cand,i,j,product
+
+
+def _greedy_scores(n_candidates,cand,order_keys,i,j,product,min_match):
+    # Greedy assignment in the same order as the single-pair functions:
+    # by decreasing product, ties broken by the order keys (lexsort
+    # treats the last key as primary)
+    scores = np.zeros(n_candidates,dtype = np.float64)
+    if len(cand) == 0:
+        return scores
+    order = np.lexsort(tuple(order_keys) + (-product,cand))
+    cand = cand[order]
+    boundaries = np.flatnonzero(np.diff(cand)) + 1
+    starts = [0] + boundaries.tolist()
+    ends = boundaries.tolist() + [len(cand)]
+    cand_list = cand.tolist()
+    i_list = i[order].tolist()
+    j_list = j[order].tolist()
+    product_list = product[order].tolist()
+    for start,end in zip(starts,ends):
+        used1 = set()
+        used2 = set()
+        score = 0.0
+        n_used = 0
+        for pos in range(start,end):
+            if not i_list[pos] in used1 and not j_list[pos] in used2:
+                score += product_list[pos]
+                used1.add(i_list[pos])
+                used2.add(j_list[pos])
+                n_used += 1
+        if n_used >= min_match:
+            scores[cand_list[start]] = score
+    return scores
+
+
+def _batch_scores(query,block,tol,min_match,shift,query_first,score_threshold,stats):
+    if len(block) == 0 or query.n_peaks == 0:
+        return np.zeros(len(block),dtype = np.float64)
+    mz_q,intensity_q = normalised_arrays(query)
+    return score_block(mz_q,intensity_q,query.parent_mz,block,tol,min_match,shift = shift,
+        query_first = query_first,score_threshold = score_threshold,stats = stats)
+
+
+# Bounds are compared against the threshold with a little slack so that
+# rounding in the bound can never prune a pair that reaches it exactly
+BOUND_SLACK = 1e-9
+
+def _add_stat(stats,key,value):
+    if stats is not None:
+        stats[key] = stats.get(key,0) + int(value)
+
+
+def score_block(mz_q,intensity_q,parent_mz_q,block,tol,min_match,shift = True,query_first = True,score_threshold = None,stats = None,return_scored = False):
+    # Scores for a query given as normalised peak arrays against block.
+    # With shift = False this is fast_cosine, otherwise fast_cosine_shift.
+    #
+    # Candidates that provably can't score are skipped before the greedy
+    # assignment: those with fewer than min_match peaks or possible matches
+    # (their score is 0 anyway) and, if score_threshold is given, those
+    # whose upper bound is below it (their score is reported as 0 rather
+    # than computed). If stats is a dict, the number of candidates seen and
+    # pruned by each rule are added to it. With return_scored, a boolean
+    # mask of the candidates that went through the full matching is
+    # returned with the scores.
+    n_candidates = len(block)
+    scores = np.zeros(n_candidates,dtype = np.float64)
+    scored = np.zeros(n_candidates,dtype = bool)
+    _add_stat(stats,'n_pairs',n_candidates)
+    if n_candidates == 0 or len(mz_q) == 0 or len(mz_q) < min_match:
+        _add_stat(stats,'n_pruned_peaks',n_candidates)
+    else:
+        enough_peaks = block.n_peaks() >= max(min_match,1)
+        _add_stat(stats,'n_pruned_peaks',n_candidates - enough_peaks.sum())
+        if not enough_peaks.all():
+            positions = np.flatnonzero(enough_peaks)
+            scores[positions],scored[positions] = _score_candidates(mz_q,intensity_q,parent_mz_q,block.take(positions),
+                tol,min_match,shift,query_first,score_threshold,stats)
+        else:
+            scores,scored = _score_candidates(mz_q,intensity_q,parent_mz_q,block,
+                tol,min_match,shift,query_first,score_threshold,stats)
+    if return_scored:
+        return scores,scored
+    return scores
+
+
+def _score_candidates(mz_q,intensity_q,parent_mz_q,block,tol,min_match,shift,query_first,score_threshold,stats):
+    n_candidates = len(block)
+    zero_shifts = np.zeros(n_candidates,dtype = np.float64)
+    if query_first:
+        # candidate peaks are spectrum 2: shifted by query - candidate
+        shift_values = parent_mz_q - block.parent_mz
+    else:
+        # the query is spectrum 2, so the matching is done from the
+        # candidates' side with the shift applied to the query peaks
+        shift_values = block.parent_mz - parent_mz_q
+    blocks = [(0,zero_shifts)]
+    if shift:
+        blocks.append((1,shift_values))
+    parts = []
+    for block_id,shifts in blocks:
+        if query_first:
+            cand,i,j,product = find_pairs_batch(mz_q,intensity_q,block,shifts,tol)
+        else:
+            cand,i,j,product = _find_pairs_reversed(mz_q,intensity_q,block,shifts,tol)
+        parts.append((cand,np.full(len(cand),block_id),i,j,product))
+    cand,block_ids,i,j,product = [np.concatenate(x) for x in zip(*parts)]
+
+    if query_first:
+        query_pos,cand_pos = i,j
+    else:
+        query_pos,cand_pos = j,i
+    alive = _candidate_bounds(block,len(mz_q),cand,query_pos,cand_pos,product,min_match,score_threshold,stats)
+    if not alive.all():
+        keep = alive[cand]
+        cand,block_ids,i,j,product = cand[keep],block_ids[keep],i[keep],j[keep],product[keep]
+    # within a block find_pairs emits pairs ordered by (i, j)
+    return _greedy_scores(n_candidates,cand,(j,i,block_ids),i,j,product,min_match),alive
+
+
+def _candidate_bounds(block,n_query_peaks,cand,query_pos,cand_pos,product,min_match,score_threshold,stats):
+    # Admissible tests on the candidate pairs found by find_pairs. Each
+    # peak is used at most once in the greedy assignment, so
+    #  - the number of matches is at most the number of distinct query
+    #    peaks (and of distinct candidate peaks) with a candidate pair
+    #  - the score is at most the sum, over the query peaks, of each peak's
+    #    best product (and likewise over the candidate peaks)
+    # Returns a boolean mask of the candidates that may still be kept.
+    n_candidates = len(block)
+    query_key = cand*n_query_peaks + query_pos
+    cand_key = block.offsets[cand] + cand_pos
+    query_owner = np.arange(n_candidates*n_query_peaks)//n_query_peaks
+    cand_owner = np.repeat(np.arange(n_candidates),block.n_peaks())
+    n_matches = None
+    bound = None
+    for key,owner in ((query_key,query_owner),(cand_key,cand_owner)):
+        best = np.zeros(len(owner),dtype = np.float64)
+        np.maximum.at(best,key,product)
+        seen = np.zeros(len(owner),dtype = bool)
+        seen[key] = True
+        side_matches = np.bincount(owner[seen],minlength = n_candidates)
+        side_bound = np.bincount(owner,weights = best,minlength = n_candidates)
+        if n_matches is None:
+            n_matches,bound = side_matches,side_bound
+        else:
+            n_matches = np.minimum(n_matches,side_matches)
+            bound = np.minimum(bound,side_bound)
+    alive = n_matches >= max(min_match,1)
+    _add_stat(stats,'n_pruned_matches',n_candidates - alive.sum())
+    if score_threshold is not None and score_threshold > 0:
+        reachable = bound + BOUND_SLACK >= score_threshold
+        _add_stat(stats,'n_pruned_bound',(alive & ~reachable).sum())
+        alive &= reachable
+    return alive
+
+
+def _find_pairs_reversed(mz2,intensity2,block,shifts,tol):
+    # pairs for candidate (spectrum 1) against the query (spectrum 2):
+    # mz1[i] - tol <= mz2[j] + shift < mz1[i] + tol, with i indexing the
+    # candidate's peaks and j the query's
+    n_peaks = block.n_peaks()
+    candidate = np.repeat(np.arange(len(block)),n_peaks)
+    shift = shifts[candidate]
+    # for a candidate peak, the matching query peaks are those with
+    # mz1 - tol <= mz2 + shift < mz1 + tol
+    first_j = np.searchsorted(mz2,block.mz - tol - shift,side = 'left')
+    last_j = np.searchsorted(mz2,block.mz + tol - shift,side = 'left')
+    # the searches above are only approximate because of rounding in the
+    # rearranged inequality, so widen by one and filter exactly below
+    first_j = np.maximum(first_j - 1,0)
+    last_j = np.minimum(last_j + 1,len(mz2))
+    counts = np.maximum(last_j - first_j,0)
+    n_pairs = counts.sum()
+    peak_pos = np.repeat(np.arange(len(block.mz)),counts)
+    run_start = np.cumsum(counts) - counts
+    j = first_j[peak_pos] + np.arange(n_pairs) - run_start[peak_pos]
+    cand = candidate[peak_pos]
+    mz1 = block.mz[peak_pos]
+    shifted = mz2[j] + shift[peak_pos]
+    keep = (shifted >= mz1 - tol) & (shifted < mz1 + tol)
+    peak_pos = peak_pos[keep]
+    j = j[keep]
+    cand = cand[keep]
+    i = peak_pos - block.offsets[cand]
+    product = block.intensity[peak_pos]*intensity2[j]
+    return cand,i,j,product
+
+
+def fast_cosine_batch(query,block,tol,min_match,query_first = True,score_threshold = None,stats = None):
+    # Score query against every spectrum in block (a PackedSpectra), giving
+    # the same scores as calling fast_cosine(query,candidate,...) for each
+    # candidate (or fast_cosine(candidate,query,...) if not query_first).
+    # If score_threshold is given, candidates that can't reach it may be
+    # reported as 0 without being scored (see score_block).
+    return _batch_scores(query,block,tol,min_match,False,query_first,score_threshold,stats)
+
+
+def fast_cosine_shift_batch(query,block,tol,min_match,query_first = True,score_threshold = None,stats = None):
+    # As fast_cosine_batch, but equivalent to fast_cosine_shift
+    return _batch_scores(query,block,tol,min_match,True,query_first,score_threshold,stats)
+
+
+# the batched equivalent of each single-pair scoring function
+BATCH_FUNCTIONS = {
+    fast_cosine: fast_cosine_batch,
+    fast_cosine_shift: fast_cosine_shift_batch,
+}
+
+# whether each batched function uses the precursor shift (see score_block)
+BATCH_SHIFT = {
+    fast_cosine_batch: False,
+    fast_cosine_shift_batch: True,
+}
+
+
 def comp_scores(spectra,file_scan,similarity_function,similarity_tolerance,min_match):
     # a method for testing -- just computes scores between a bunch of scans
     specs = []
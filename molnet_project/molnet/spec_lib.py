@@ -8,17 +8,29 @@ MOLNET_PATH = '/Users/simon/git/molnet/code'
 import sys
 sys.path.append(MOLNET_PATH)
 
-from molnet.scoring_functions import fast_cosine,fast_cosine_shift
+from molnet.scoring_functions import fast_cosine,fast_cosine_shift,pack_spectra,BATCH_FUNCTIONS
 
 class SpecLib(object):
     def __init__(self,mgf_file):
         self.mgf_file = mgf_file
         self.spectra = None
-    def _load_mgf(self,id_field='SPECTRUMID'):
-        from mnet_utilities import load_mgf
-        self.spectra = load_mgf(self.mgf_file,id_field = id_field)
-        for k,v in self.spectra.items():
+    def _load_mgf(self,id_field='SPECTRUMID',pipeline = None,compact = False):
+        # stream the spectra in, optionally preprocessing them as they come
+        # (see molnet.mgf.read_mgf)
+        from molnet.mgf import read_mgf
+        self.spectra = {}
+        for k,v in read_mgf(self.mgf_file,id_field = id_field,pipeline = pipeline,compact = compact):
             v.spectrum_id = k
+            self.spectra[k] = v
+
+    def compact(self,dtype = None):
+        # replace the spectra with CompactSpectrum objects to save memory
+        from molnet.mnet import compact_spectrum
+        for k,v in self.spectra.items():
+            if dtype is None:
+                self.spectra[k] = compact_spectrum(v)
+            else:
+                self.spectra[k] = compact_spectrum(v,dtype = dtype)
 
     def get_n_spec(self):
         return len(self.spectra)
@@ -30,13 +42,10 @@ class SpecLib(object):
         return [s.n_peaks for s in self.spectra.values()]
 
     def filter(self):
-        # top_k_filter
-        n_done = 0
-        for s_id,spec in self.spectra.items():
-            spec.keep_top_k()
-            n_done += 1
-            if n_done % 100 == 0:
-                print("Filtered {}".format(n_done))
+        # top_k_filter, on all the spectra at once
+        from molnet.preprocessing import Pipeline
+        Pipeline([('keep_top_k',{})]).apply(self.spectra.values())
+        print("Filtered {}".format(len(self.spectra)))
 
     
     def spectral_match(self,query,
@@ -44,12 +53,21 @@ class SpecLib(object):
             ms2_tol = 0.2,
             min_match_peaks = 1,
             ms1_tol = 0.2,
-            score_thresh = 0.7):
+            score_thresh = 0.7,
+            stats = None):
         # make a sorted list for quick precursor matching
         spec_list = [s for s in self.spectra.values()]
         spec_list.sort()
         candidates = self._candidates(spec_list,query.precursor_mz,ms1_tol)
         hits = []
+        batch_function = BATCH_FUNCTIONS.get(scoring_function,None)
+        if batch_function:
+            scores = batch_function(query,pack_spectra(candidates),ms2_tol,min_match_peaks,
+                score_threshold = score_thresh,stats = stats)
+            for c,sc in zip(candidates,scores.tolist()):
+                if sc >= score_thresh:
+                    hits.append((c.spectrum_id,sc))
+            return hits
         for c in candidates:
             sc,_ = scoring_function(query,c,ms2_tol,min_match_peaks)
             if sc >= score_thresh: